@@ -48,10 +48,18 @@ LAMBDA_ENDPOINT_URL = os.environ.get('LAMBDA_ENDPOINT_URL', _local_url(4574))
 S3_URL_PATTERN = urllib.parse.urljoin(S3_ENDPOINT_URL, '/{b}/{k}')
 SQS_QUEUEURL = urllib.parse.urljoin(SQS_ENDPOINT_URL, '/queue/tiles')
 
+# Local directory for keeping tile bodies between warm Lambda invocations.
+#
+# Tile objects never change under a given prefix, so they are safe to reuse
+# from disk. Left unset locally so tests and development always read S3.
+
+TILE_CACHE_DIR = os.environ.get('TILE_CACHE_DIR')
+
 if os.environ.get('AWS') == 'amazonaws.com':
     S3_ENDPOINT_URL, SQS_ENDPOINT_URL, LAMBDA_ENDPOINT_URL = None, None, None
     S3_URL_PATTERN = 'https://{b}.s3.amazonaws.com/{k}'
     SQS_QUEUEURL = os.environ.get('SQS_QUEUEURL')
+    TILE_CACHE_DIR = os.environ.get('TILE_CACHE_DIR', '/tmp/planscore-tiles')
 
 # Time limit to process an upload, in seconds
 
@@ -64,4 +72,8 @@ ROUND_FLOAT = 4
 
 # For now, limit the number of tiles to run in parallel
 
-MAX_TILES_RUN = 16
\ No newline at end of file
+MAX_TILES_RUN = 16
+
+# Free space to leave in TILE_CACHE_DIR, in bytes
+
+TILE_CACHE_MIN_FREE = 128 * 1024 * 1024
@@ -3,9 +3,9 @@
 Performs as many tile-based accumulations of district votes as possible within
 AWS Lambda time limit before recursively calling for remaining tiles.
 '''
-import collections, json, io, gzip, statistics, time, base64, posixpath, pickle, functools, logging, time
+import collections, json, io, gzip, zlib, statistics, time, base64, posixpath, pickle, functools, itertools, logging, time, concurrent.futures, math, bisect
 from osgeo import ogr
-import boto3, botocore.exceptions, ModestMaps.OpenStreetMap, ModestMaps.Core
+import boto3, botocore.exceptions
 from . import prepare_state, score, data, constants, compactness, util
 
 ogr.UseExceptions()
@@ -13,12 +13,23 @@ ogr.UseExceptions()
 FUNCTION_NAME = 'PlanScore-RunDistrict'
 LOGGER_NAME = f'{__name__}.consume_tiles'
 
-# Borrow some Modest Maps tile math
-_mercator = ModestMaps.OpenStreetMap.Provider().projection
+# Number of upcoming tiles to load from S3 ahead of scoring
+PREFETCH_TILES = 8
+
+# Largest district WKB to carry along in events instead of reading from S3,
+# leaving room under the 256KB limit for asynchronous Lambda payloads.
+EVENT_GEOMETRY_MAX_BYTES = 96 * 1024
+
+# Reusable compact encoder for precinct geometries handed to OGR
+_geometry_encoder = json.JSONEncoder(separators=(',', ':'), check_circular=False)
 
 class Partial:
     ''' Partially-calculated district sums, used by consume_tiles().
     '''
+    __slots__ = ('index', 'totals', 'compactness', 'precincts', 'geometry_key',
+        'tiles', 'upload', '_ogr_geometry', '_envelope', '_edge_grid', '_tile_geoms',
+        '_row_crossings')
+    
     def __init__(self, index, totals, compactness, precincts, tiles, geometry_key, upload, ogr_geometry):
         self.index = index
         self.totals = totals
@@ -29,7 +40,10 @@ class Partial:
         self.upload = upload
         
         self._ogr_geometry = ogr_geometry
+        self._envelope = ogr_geometry.GetEnvelope() if ogr_geometry is not None else None
+        self._edge_grid = None
         self._tile_geoms = {}
+        self._row_crossings = {}
     
     def to_dict(self):
         return dict(index=self.index, totals=self.totals,
@@ -37,9 +51,18 @@ class Partial:
             tiles=self.tiles, upload=self.upload.to_dict())
     
     def to_event(self):
-        return dict(index=self.index, totals=self.totals, tiles=self.tiles,
+        event = dict(index=self.index, totals=self.totals, tiles=self.tiles,
             compactness=self.compactness, geometry_key=self.geometry_key,
             upload=self.upload.to_dict(), precincts=Partial.scrunch(self.precincts))
+        
+        if self.geometry is not None:
+            geometry_wkb = bytes(self.geometry.ExportToWkb(ogr.wkbNDR))
+        
+            if len(geometry_wkb) <= EVENT_GEOMETRY_MAX_BYTES:
+                # Save the next invocation a trip to S3 for its geometry
+                event.update(geometry_wkb=Partial.scrunch(geometry_wkb))
+        
+        return event
     
     @property
     def geometry(self):
@@ -55,8 +78,17 @@ class Partial:
             return self.geometry
         
         elif tile_zxy not in self._tile_geoms:
-            tile_geom = tile_geometry(tile_zxy)
-            self._tile_geoms[tile_zxy] = tile_geom.Intersection(self.geometry)
+            tile_xxyy = tile_envelope(tile_zxy)
+            district_xxyy = self._envelope
+            
+            # Tiles are axis-aligned rectangles, so compare envelopes first
+            # and skip the polygon intersection when the answer is obvious.
+            if prepare_state.envelope_contains(tile_xxyy, district_xxyy):
+                self._tile_geoms[tile_zxy] = self.geometry
+            elif prepare_state.envelopes_disjoint(tile_xxyy, district_xxyy):
+                self._tile_geoms[tile_zxy] = ogr.Geometry(ogr.wkbGeometryCollection)
+            else:
+                self._tile_geoms[tile_zxy] = tile_geometry(tile_zxy).Intersection(self.geometry)
         
         return self._tile_geoms[tile_zxy]
     
@@ -64,8 +96,47 @@ class Partial:
     def contains_tile(self, tile_zxy):
         ''' Return true if the named tile is contained entirely within this district.
         '''
+        tile_xxyy = tile_envelope(tile_zxy)
+        
+        if not prepare_state.envelope_contains(self._envelope, tile_xxyy):
+            # District can't contain a tile that sticks out of its envelope
+            return False
+        
+        if self._edge_grid is None:
+            self._edge_grid = EdgeGrid(self.geometry)
+        
+        if not self._edge_grid.intersects(tile_xxyy):
+            # No district boundary near the tile, so it's all in or all out
+            # and counting boundary crossings west of its center decides.
+            (zoom, _, row) = map(int, tile_zxy.split('/'))
+            (xmin, xmax, _, _) = tile_xxyy
+            
+            if self.geometry.GetDimension() < 2:
+                # Lines and points have no inside to contain anything
+                return False
+            elif zoom not in self._row_crossings:
+                self._row_crossings[zoom] = tile_row_crossings(self.geometry, zoom)
+            
+            return crossings_contain(self._row_crossings[zoom].get(row, []), (xmin + xmax) / 2)
+        
         return self.geometry.Contains(tile_geometry(tile_zxy))
     
+    @functools.lru_cache()
+    def classify_tile(self, tile_zxy):
+        ''' Return "inside", "outside", or "overlap" for the named tile.
+        
+            A tile_zxy of None stands for precincts with no tile, which are
+            always treated as overlapping.
+        '''
+        if tile_zxy is None:
+            return 'overlap'
+        elif self.contains_tile(tile_zxy):
+            return 'inside'
+        elif self.tile_geometry(tile_zxy).IsEmpty():
+            return 'outside'
+        
+        return 'overlap'
+    
     @staticmethod
     def from_event(event, storage):
         totals = event.get('totals')
@@ -76,8 +147,11 @@ class Partial:
         upload = data.Upload.from_dict(event['upload'])
         geometry_key = event['geometry_key']
         
-        object = storage.s3.get_object(Bucket=storage.bucket, Key=geometry_key)
-        geometry = ogr.CreateGeometryFromWkt(object['Body'].read().decode('utf8'))
+        if 'geometry_wkb' in event:
+            geometry = ogr.CreateGeometryFromWkb(Partial.unscrunch(event['geometry_wkb']))
+        else:
+            object = storage.s3.get_object(Bucket=storage.bucket, Key=geometry_key)
+            geometry = util.load_geometry(object['Body'].read())
         
         if totals is None or compactness is None or precincts is None or tiles is None:
             totals, compactness = collections.defaultdict(int), {}
@@ -90,7 +164,9 @@ class Partial:
     def scrunch(thing):
         ''' Scrunch a thing into a compact (?) textual representation.
         '''
-        return base64.a85encode(gzip.compress(pickle.dumps(thing))).decode('ascii')
+        # Default gzip level 9 costs time for little gain over level 6 here
+        pickled = pickle.dumps(thing, protocol=pickle.HIGHEST_PROTOCOL)
+        return base64.a85encode(gzip.compress(pickled, compresslevel=6)).decode('ascii')
     
     @staticmethod
     def unscrunch(thing):
@@ -101,20 +177,100 @@ class Partial:
         if type(thing) in (tuple, list, dict):
             return thing
 
-        return pickle.loads(gzip.decompress(base64.a85decode(thing)))
+        return pickle.loads(zlib.decompress(base64.a85decode(thing), 16 + zlib.MAX_WBITS))
 
-@functools.lru_cache(maxsize=16)
-def tile_geometry(tile_zxy):
-    ''' Get an OGR Geometry for a web mercator tile.
+class EdgeGrid:
+    ''' Uniform grid of boundary edge envelopes, for finding edges near a tile.
+    '''
+    def __init__(self, geometry, size=64):
+        xmin, xmax, ymin, ymax = geometry.GetEnvelope()
+        self.xmin, self.ymin, self.size = xmin, ymin, size
+        self.cell_width = (xmax - xmin) / size or 1
+        self.cell_height = (ymax - ymin) / size or 1
+        self.cells = collections.defaultdict(list)
+        
+        for ((x1, y1), (x2, y2)) in iter_geometry_edges(geometry):
+            edge_xxyy = (min(x1, x2), max(x1, x2), min(y1, y2), max(y1, y2))
+            for cell in self.iter_cells(edge_xxyy):
+                self.cells[cell].append(edge_xxyy)
+    
+    def iter_cells(self, xxyy):
+        ''' Generate (column, row) grid cells covering an envelope.
+        '''
+        (xmin, xmax, ymin, ymax), last = xxyy, self.size - 1
+        col1 = min(max(int((xmin - self.xmin) / self.cell_width), 0), last)
+        col2 = min(max(int((xmax - self.xmin) / self.cell_width), 0), last)
+        row1 = min(max(int((ymin - self.ymin) / self.cell_height), 0), last)
+        row2 = min(max(int((ymax - self.ymin) / self.cell_height), 0), last)
+        
+        return itertools.product(range(col1, col2 + 1), range(row1, row2 + 1))
+    
+    def intersects(self, xxyy):
+        ''' Return true if any edge envelope touches the given envelope.
+        '''
+        for cell in self.iter_cells(xxyy):
+            for edge_xxyy in self.cells.get(cell, ()):
+                if not prepare_state.envelopes_disjoint(edge_xxyy, xxyy):
+                    return True
+        
+        return False
+
+def iter_geometry_edges(geometry):
+    ''' Generate ((x1, y1), (x2, y2)) line segments from rings and lines of a geometry.
+    '''
+    if geometry.GetGeometryCount():
+        for index in range(geometry.GetGeometryCount()):
+            yield from iter_geometry_edges(geometry.GetGeometryRef(index))
+        return
+    
+    points = [point[:2] for point in geometry.GetPoints() or []]
+    yield from zip(points[:-1], points[1:])
+
+def tile_row_crossings(geometry, zoom):
+    ''' Return longitudes where polygon edges cross each tile row's center line.
+    
+        Result is a dictionary of sorted lists keyed by row at the given zoom.
+        Edges are read once, after which any tile center away from the edges
+        can be located with crossings_contain() instead of a GEOS predicate.
+    '''
+    crossings, last_row = collections.defaultdict(list), 2**zoom - 1
+    
+    for ((x1, y1), (x2, y2)) in iter_geometry_edges(geometry):
+        ymin, ymax = min(y1, y2), max(y1, y2)
+        row1 = max(math.floor(prepare_state.tile_row(ymax, zoom)), 0)
+        row2 = min(math.floor(prepare_state.tile_row(ymin, zoom)), last_row)
+        
+        for row in range(row1, row2 + 1):
+            # Same arithmetic as the center of tile_envelope(), for exact matches
+            y = (prepare_state.tile_latitude(row + 1, zoom) + prepare_state.tile_latitude(row, zoom)) / 2
+
+            # Half-open span counts a crossing at a shared vertex only once
+            if ymin <= y < ymax:
+                crossings[row].append(x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+    
+    for row_crossings in crossings.values():
+        row_crossings.sort()
+    
+    return crossings
+
+def crossings_contain(row_crossings, x):
+    ''' Return true if a point is inside polygon by even-odd rule for its row crossings.
+    '''
+    return bisect.bisect_left(row_crossings, x) % 2 == 1
+
+@functools.lru_cache(maxsize=65536)
+def tile_envelope(tile_zxy):
+    ''' Get an (xmin, xmax, ymin, ymax) envelope for a web mercator tile.
     '''
     (z, x, y) = map(int, tile_zxy.split('/'))
-    coord = ModestMaps.Core.Coordinate(y, x, z)
-    NW = _mercator.coordinateLocation(coord)
-    SE = _mercator.coordinateLocation(coord.right().down())
-    wkt = 'POLYGON(({W} {N},{W} {S},{E} {S},{E} {N},{W} {N}))'.format(
-        N=NW.lat, W=NW.lon, S=SE.lat, E=SE.lon)
+    return (prepare_state.tile_longitude(x, z), prepare_state.tile_longitude(x + 1, z),
+        prepare_state.tile_latitude(y + 1, z), prepare_state.tile_latitude(y, z))
 
-    return ogr.CreateGeometryFromWkt(wkt)
+def tile_geometry(tile_zxy):
+    ''' Get an OGR Geometry for a web mercator tile.
+    '''
+    (W, E, S, N) = tile_envelope(tile_zxy)
+    return prepare_state.bbox_geometry(W, S, E, N)
 
 def lambda_handler(event, context):
     '''
@@ -175,7 +331,7 @@ def post_score_results(storage, partial):
     ''' Post single-district counts.
     '''
     key = partial.upload.district_key(partial.index)
-    body = json.dumps(partial.to_dict(), indent=2).encode('utf8')
+    body = json.dumps(partial.to_dict(), separators=(',', ':')).encode('utf8')
     
     print('Uploading', len(body), 'bytes to', key)
     
@@ -195,29 +351,62 @@ def consume_tiles(storage, partial):
     # Yield once with an emptied precincts list.
     yield
     
-    # Iterate over each tile, loading precincts and scoring them.
-    while partial.tiles:
-        tile_zxy, start_time = partial.tiles.pop(0), time.time()
-        for precinct in load_tile_precincts(storage, tile_zxy):
-            score_precinct(partial, precinct, tile_zxy)
-
-        # message = dict(prefix=storage.prefix, upload=partial.upload.id,
-        #     tile=tile_zxy, time=round(time.time() - start_time, 3),
-        #     **get_tile_metadata(storage, tile_zxy))
-        # 
-        # logging.getLogger(LOGGER_NAME).debug(json.dumps(message))
+    # Iterate over each tile, loading precincts and scoring them. S3 requests
+    # for upcoming tiles run in threads so their latency overlaps scoring.
+    with concurrent.futures.ThreadPoolExecutor(PREFETCH_TILES) as executor:
+        pending = collections.deque()
         
-        # Yield after each complete tile is processed.
-        yield
+        while partial.tiles:
+            while len(pending) < min(len(partial.tiles), PREFETCH_TILES):
+                next_tile_zxy = partial.tiles[len(pending)]
+                pending.append(executor.submit(load_tile_precincts, storage, next_tile_zxy))
+            
+            tile_zxy, start_time = partial.tiles.pop(0), time.time()
+            for precinct in pending.popleft().result():
+                score_precinct(partial, precinct, tile_zxy)
+
+            # message = dict(prefix=storage.prefix, upload=partial.upload.id,
+            #     tile=tile_zxy, time=round(time.time() - start_time, 3),
+            #     **get_tile_metadata(storage, tile_zxy))
+            # 
+            # logging.getLogger(LOGGER_NAME).debug(json.dumps(message))
+            
+            # Yield after each complete tile is processed.
+            yield
 
 def score_precinct(partial, precinct, tile_zxy):
     '''
     '''
-    precinct_geom = ogr.CreateGeometryFromJson(json.dumps(precinct['geometry']))
+    tile_class = partial.classify_tile(tile_zxy)
+    
+    if tile_class == 'outside':
+        # If the whole tile misses the district, don't bother.
+        return
+    
+    geometry = precinct['geometry']
+    
+    if geometry and geometry['type'] == 'Point' and len(geometry['coordinates']) >= 2:
+        # Check block-points directly from coordinates without parsing GeoJSON
+        (x, y), (xmin, xmax, ymin, ymax) = geometry['coordinates'][:2], partial._envelope
+        
+        if tile_class == 'inside':
+            score_properties(partial, precinct['properties'], 1)
+        elif xmin <= x <= xmax and ymin <= y <= ymax:
+            point_geom = ogr.Geometry(ogr.wkbPoint)
+            point_geom.AddPoint_2D(x, y)
+            point_within = point_geom.Within(partial.tile_geometry(tile_zxy))
+            score_properties(partial, precinct['properties'], 1 if point_within else 0)
+        
+        return
+    
+    precinct_geom = ogr.CreateGeometryFromJson(_geometry_encoder.encode(precinct['geometry']))
     
     if precinct_geom is None or precinct_geom.IsEmpty():
         # If there's no geometry here, don't bother.
         return
+    elif prepare_state.envelopes_disjoint(precinct_geom.GetEnvelope(), partial._envelope):
+        # If it's nowhere near the district, don't bother.
+        return
     elif precinct_geom.GetGeometryType() in (ogr.wkbPoint,
         ogr.wkbPoint25D, ogr.wkbMultiPoint, ogr.wkbMultiPoint25D):
         # Points have no area
@@ -231,7 +420,7 @@ def score_precinct(partial, precinct, tile_zxy):
         # If there's no overlap here, don't bother.
         return
 
-    if partial.contains_tile(tile_zxy):
+    if tile_class == 'inside':
         # Don't laboriously calculate precinct fraction if we know it's all there.
         # This is safe because precincts are clipped on tile boundaries, so a
         # fully-contained tile necessarily means the precinct is also contained.
@@ -241,27 +430,38 @@ def score_precinct(partial, precinct, tile_zxy):
         tile_geom = partial.tile_geometry(tile_zxy)
         precinct_fraction = precinct_frac if precinct_geom.Within(tile_geom) else 0
     else:
+        # Intersect with the district already trimmed to this tile, which is
+        # built once per tile and far simpler than the whole district.
+        tile_geom = partial.tile_geometry(tile_zxy)
+        precinct_area = precinct['properties'].get(prepare_state.AREA_FIELD)
         try:
-            overlap_geom = precinct_geom.Intersection(partial.tile_geometry(tile_zxy))
+            overlap_geom = precinct_geom.Intersection(tile_geom)
         except RuntimeError as e:
             if 'TopologyException' in str(e) and not precinct_geom.IsValid():
                 # Sometimes, a precinct geometry can be invalid
                 # so inflate it by a tiny amount to smooth out problems
                 precinct_geom = precinct_geom.Buffer(0.0000001)
-                overlap_geom = precinct_geom.Intersection(partial.geometry)
+                precinct_area = None
+                overlap_geom = precinct_geom.Intersection(tile_geom)
             else:
                 raise
-        if precinct_geom.Area() == 0:
+        if precinct_area is None:
+            # Tiles built before areas were recorded need it calculated here
+            precinct_area = precinct_geom.Area()
+        if precinct_area == 0:
             # If we're about to divide by zero, don't bother.
             return
 
-        overlap_area = overlap_geom.Area() / precinct_geom.Area()
+        overlap_area = overlap_geom.Area() / precinct_area
         precinct_fraction = overlap_area * precinct_frac
     
-    for name in score.FIELD_NAMES:
-        if name not in precinct['properties']:
-            continue
-        precinct_value = precinct_fraction * (precinct['properties'][name] or 0)
+    score_properties(partial, precinct['properties'], precinct_fraction)
+
+def score_properties(partial, properties, precinct_fraction):
+    ''' Add a fraction of each scored precinct property to partial totals.
+    '''
+    for name in score.scored_field_names(tuple(properties)):
+        precinct_value = precinct_fraction * (properties[name] or 0)
         partial.totals[name] = round(partial.totals[name] + precinct_value, constants.ROUND_COUNT)
 
 def get_tile_metadata(storage, tile_zxy):
@@ -279,19 +479,25 @@ def get_tile_metadata(storage, tile_zxy):
 
 def load_tile_precincts(storage, tile_zxy):
     ''' Get GeoJSON features for a specific tile.
+    
+        Decompressed tile bodies are kept in a local cache when configured,
+        so continuing invocations in a warm container can skip S3.
     '''
-    try:
-        object = storage.s3.get_object(Bucket=storage.bucket,
-            Key='{}/{}.geojson'.format(storage.prefix, tile_zxy))
-    except botocore.exceptions.ClientError as error:
-        if error.response['Error']['Code'] == 'NoSuchKey':
-            return []
-        raise
+    key = '{}/{}.geojson'.format(storage.prefix, tile_zxy)
+    body = util.read_cached_object(storage.bucket, key)
+    
+    if body is None:
+        try:
+            object = storage.s3.get_object(Bucket=storage.bucket, Key=key)
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] == 'NoSuchKey':
+                return []
+            raise
 
-    if object.get('ContentEncoding') == 'gzip':
-        object['Body'] = io.BytesIO(gzip.decompress(object['Body'].read()))
+        body = util.read_object_body(object)
+        util.write_cached_object(storage.bucket, key, body)
     
-    geojson = json.load(object['Body'])
+    geojson = json.loads(body)
     return geojson['features']
 
 def iterate_precincts(storage, precincts, tiles):
@@ -320,12 +526,28 @@ def get_geometry_tile_zxys(district_geom):
     xxyy_extent = district_geom.GetEnvelope()
     iter = prepare_state.iter_extent_tiles(xxyy_extent, prepare_state.TILE_ZOOM)
     tiles = []
+    
+    # Points have no edges to look for, so they always get full checks
+    edge_grid = EdgeGrid(district_geom) if district_geom.GetDimension() > 0 else None
+    
+    # Lines have no inside, so they never need crossings to locate tile centers
+    if district_geom.GetDimension() == 2:
+        row_crossings = tile_row_crossings(district_geom, prepare_state.TILE_ZOOM)
+    else:
+        row_crossings = None
 
-    for (coord, tile_wkt) in iter:
-        tile_zxy = '{zoom}/{column}/{row}'.format(**coord.__dict__)
-        tile_geom = ogr.CreateGeometryFromWkt(tile_wkt)
+    for (coord, x1, y1, x2, y2) in iter:
+        tile_zxy = f'{coord.zoom}/{coord.column}/{coord.row}'
+        
+        if edge_grid is not None and not edge_grid.intersects((x1, x2, y1, y2)):
+            # No district edges near this tile, so its center point decides
+            tile_intersects = row_crossings is not None and crossings_contain(
+                row_crossings.get(coord.row, []), (x1 + x2) / 2)
+        else:
+            tile_geom = prepare_state.bbox_geometry(x1, y1, x2, y2)
+            tile_intersects = tile_geom.Intersects(district_geom)
         
-        if tile_geom.Intersects(district_geom):
+        if tile_intersects:
             tiles.append(tile_zxy)
     
     return tiles
@@ -1,65 +1,359 @@
-import argparse, math, itertools, io, gzip, os
+import argparse, math, itertools, io, gzip, os, json, functools, collections, multiprocessing, concurrent.futures
 from osgeo import ogr, osr
-import boto3, ModestMaps.Geo, ModestMaps.Core
+import boto3, boto3.s3.transfer, ModestMaps.Core
 from . import constants
 
 TILE_ZOOM = 12
 FRACTION_FIELD = 'PlanScore:Fraction'
+AREA_FIELD = 'PlanScore:Area'
 KEY_FORMAT = 'data/{directory}/{zxy}.geojson'
 
 EPSG4326 = osr.SpatialReference(); EPSG4326.ImportFromEPSG(4326)
 
-def get_projection():
-    ''' Return a spherical mercator MMaps Projection instance.
+POLYGON_TYPES = (ogr.wkbPolygon, ogr.wkbPolygon25D, ogr.wkbMultiPolygon, ogr.wkbMultiPolygon25D)
+
+# Split larger tiles into concurrent multipart uploads
+TRANSFER_CONFIG = boto3.s3.transfer.TransferConfig(multipart_threshold=8*1024*1024,
+    max_concurrency=10, use_threads=True)
+
+# Most tile uploads to keep in flight while more tiles are processed
+MAX_UPLOADS = 16
+
+def tile_longitude(column, zoom):
+    ''' Return west edge longitude of a spherical mercator tile column.
+    '''
+    return column / 2**zoom * 360 - 180
+
+def tile_latitude(row, zoom):
+    ''' Return north edge latitude of a spherical mercator tile row.
+    '''
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / 2**zoom))))
+
+def tile_column(lon, zoom):
+    ''' Return fractional spherical mercator tile column for a longitude.
     '''
-    pi = math.pi
-    tx = ModestMaps.Geo.deriveTransformation(-pi, pi, 0, 0, pi, pi, 1, 0, -pi, -pi, 0, 1)
-    return ModestMaps.Geo.MercatorProjection(0, tx)
+    return (lon + 180) / 360 * 2**zoom
+
+def tile_row(lat, zoom):
+    ''' Return fractional spherical mercator tile row for a latitude.
+    '''
+    lat = max(-89.9, min(89.9, lat))
+    return (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * 2**zoom
 
 def iter_extent_tiles(xxyy_extent, zoom):
-    ''' Generate a stream of (MMaps Coordinate, geometry WKT) tuples.
+    ''' Generate a stream of (MMaps Coordinate, x1, y1, x2, y2) tuples.
     
         Extent is given as four-elements (xmin, xmax, ymin, ymax) to match
         values returned from layer.GetExtent() and geometry.GetEnvelope().
+        Tile bounds are given as west, south, east, north.
     '''
-    mercator = get_projection()
-    wkt_format = 'POLYGON(({x1} {y1}, {x1} {y2}, {x2} {y2}, {x2} {y1}, {x1} {y1}))'
-    
     w, e, s, n = xxyy_extent
-    nw, se = ModestMaps.Geo.Location(n, w), ModestMaps.Geo.Location(s, e)
-    ul, lr = [mercator.locationCoordinate(loc).zoomTo(zoom).container() for loc in (nw, se)]
-    rows, columns = range(ul.row, lr.row + 1), range(ul.column, lr.column + 1)
+    rows = range(math.floor(tile_row(n, zoom)), math.floor(tile_row(s, zoom)) + 1)
+    columns = range(math.floor(tile_column(w, zoom)), math.floor(tile_column(e, zoom)) + 1)
+    
+    # Tile edges are shared along each row and column, so calculate them
+    # once up front instead of separately for every tile in the extent.
+    lats = {row: tile_latitude(row, zoom) for row in range(rows.start, rows.stop + 1)}
+    lons = {col: tile_longitude(col, zoom) for col in range(columns.start, columns.stop + 1)}
+    
+    Coordinate = ModestMaps.Core.Coordinate
     
     for (row, column) in itertools.product(rows, columns):
-        tile_ul = ModestMaps.Core.Coordinate(row, column, zoom)
-        tile_lr = tile_ul.down().right()
-        tile_nw = mercator.coordinateLocation(tile_ul)
-        tile_se = mercator.coordinateLocation(tile_lr)
+        yield (Coordinate(row, column, zoom), lons[column], lats[row + 1], lons[column + 1], lats[row])
+
+def hilbert_distance(row, column, zoom):
+    ''' Return distance of a tile along a Hilbert curve covering its zoom level.
+    '''
+    size, x, y, distance = 2**zoom, column, row, 0
+    step = size // 2
+    
+    while step > 0:
+        rx, ry = int(x & step > 0), int(y & step > 0)
+        distance += step * step * ((3 * rx) ^ ry)
         
-        x1, y1, x2, y2 = tile_nw.lon, tile_se.lat, tile_se.lon, tile_nw.lat
-        bbox_wkt = wkt_format.format(**locals())
+        if ry == 0:
+            # Rotate quadrant so the curve stays continuous
+            if rx == 1:
+                x, y = size - 1 - x, size - 1 - y
+            x, y = y, x
+        
+        step //= 2
+    
+    return distance
+
+def index_layer_tiles(layer, zoom, transform=None):
+    ''' Return a dictionary of feature ID lists keyed on (row, column) tuples.
+    
+        Features are indexed under every tile touched by their envelope,
+        including tiles whose edge they only touch. Pass an OSR transformation
+        to EPSG:4326 for layers in another projection, so envelopes match the
+        reprojected geometries that tiles are clipped from.
+    '''
+    tile_fids, max_coord = collections.defaultdict(list), 2**zoom - 1
+    
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        
+        if geometry is None:
+            continue
+        
+        if transform is not None:
+            geometry.Transform(transform)
+        
+        xmin, xmax, ymin, ymax = geometry.GetEnvelope()
+        cmin = max(0, math.ceil(tile_column(xmin, zoom)) - 1)
+        cmax = min(max_coord, math.floor(tile_column(xmax, zoom)))
+        rmin = max(0, math.ceil(tile_row(ymax, zoom)) - 1)
+        rmax = min(max_coord, math.floor(tile_row(ymin, zoom)))
+        
+        for (row, column) in itertools.product(range(rmin, rmax + 1), range(cmin, cmax + 1)):
+            tile_fids[(row, column)].append(feature.GetFID())
+    
+    return tile_fids
+
+def iter_tile_features(layer, fids, bbox_geom, bbox_xxyy, get_feature=None):
+    ''' Generate a stream of indexed features that intersect a bbox.
+    
+        Matches what layer.SetSpatialFilter(bbox_geom) would return, without
+        walking the layer's own spatial index for every tile. Pass a function
+        of feature ID to read features some other way than layer.GetFeature().
+    '''
+    if get_feature is None:
+        get_feature = layer.GetFeature
+    
+    for fid in fids:
+        feature = get_feature(fid)
+        geometry = feature.GetGeometryRef()
         
-        yield (tile_ul, bbox_wkt)
+        if envelope_contains(bbox_xxyy, geometry.GetEnvelope()) \
+        or geometry.Intersects(bbox_geom):
+            yield feature
+
+def bbox_geometry(x1, y1, x2, y2):
+    ''' Return a rectangular OGR polygon, built directly without parsing WKT.
+    '''
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    
+    for (x, y) in ((x1, y1), (x1, y2), (x2, y2), (x2, y1), (x1, y1)):
+        ring.AddPoint_2D(x, y)
+    
+    bbox_geom = ogr.Geometry(ogr.wkbPolygon)
+    bbox_geom.AddGeometry(ring)
+    
+    return bbox_geom
 
-def excerpt_feature(original_feature, bbox_geom):
-    ''' Return a cloned feature trimmed to the bbox and marked with a fraction.
+def envelope_contains(outer_xxyy, inner_xxyy):
+    ''' Return true if inner (xmin, xmax, ymin, ymax) envelope is within outer.
     '''
-    original_geometry = original_feature.GetGeometryRef()
-    new_feature = original_feature.Clone()
-    intersection_geometry = original_geometry.Clone().Intersection(bbox_geom)
-    intersection_geometry.TransformTo(EPSG4326)
-    new_feature.SetGeometry(intersection_geometry)
+    (oxmin, oxmax, oymin, oymax), (ixmin, ixmax, iymin, iymax) = outer_xxyy, inner_xxyy
+    return oxmin <= ixmin and ixmax <= oxmax and oymin <= iymin and iymax <= oymax
+
+def envelopes_disjoint(xxyy1, xxyy2):
+    ''' Return true if two (xmin, xmax, ymin, ymax) envelopes share no points.
+    '''
+    (xmin1, xmax1, ymin1, ymax1), (xmin2, xmax2, ymin2, ymax2) = xxyy1, xxyy2
+    return xmax1 < xmin2 or xmax2 < xmin1 or ymax1 < ymin2 or ymax2 < ymin1
+
+def excerpt_geometry(original_geometry, bbox_geom, bbox_xxyy=None):
+    ''' Return a new geometry trimmed to the bbox, and its fraction.
+    
+        Original geometry and bbox are both expected in EPSG:4326, as read
+        through cached_feature(). Bbox geometry is expected to be an
+        axis-aligned rectangle, and its (xmin, xmax, ymin, ymax) envelope can
+        be passed in if already known. Fraction is None for non-polygons.
+    '''
+    if bbox_xxyy is None:
+        bbox_xxyy = bbox_geom.GetEnvelope()
+    
+    is_polygon = original_geometry.GetGeometryType() in POLYGON_TYPES
+    
+    if envelope_contains(bbox_xxyy, original_geometry.GetEnvelope()):
+        # Skip the costly intersection, nothing outside the bbox to trim off
+        intersection_geometry = original_geometry.Clone()
+    else:
+        intersection_geometry = original_geometry.Intersection(bbox_geom)
     
-    if original_geometry.GetGeometryType() in (ogr.wkbPolygon,
-        ogr.wkbPolygon25D, ogr.wkbMultiPolygon, ogr.wkbMultiPolygon25D):
+    if is_polygon:
         # Only attempt to calculate out a fraction for an original polygon
         fraction = intersection_geometry.GetArea() / original_geometry.GetArea()
-        new_feature.SetField(FRACTION_FIELD, fraction)
     else:
-        # Set fraction to null otherwise
-        new_feature.UnsetField(FRACTION_FIELD)
+        fraction = None
+    
+    return intersection_geometry, fraction
+
+def excerpt_feature_json(original_feature, field_names, bbox_geom, bbox_xxyy=None):
+    ''' Return a GeoJSON string for a feature trimmed to the bbox with a fraction.
+    
+        Area is also recorded if an area field is named. See excerpt_geometry()
+        for optional arguments.
+    '''
+    properties = {name: original_feature.GetField(i) for (i, name) in enumerate(field_names)}
+    
+    geometry, properties[FRACTION_FIELD] = excerpt_geometry(
+        original_feature.GetGeometryRef(), bbox_geom, bbox_xxyy)
+    
+    geometry_json = export_geometry_json(geometry)
+    
+    if properties[FRACTION_FIELD] is not None and AREA_FIELD in properties:
+        # Measure the rounded coordinates that scoring will read back
+        properties[AREA_FIELD] = ogr.CreateGeometryFromJson(geometry_json).GetArea()
+    
+    return geojson_feature(geometry_json, properties, original_feature.GetFID())
+
+def export_geometry_json(geometry):
+    ''' Return a GeoJSON string for an OGR geometry, rounded as written to tiles.
+    '''
+    if geometry is None:
+        return 'null'
+    
+    return geometry.ExportToJson(options=['COORDINATE_PRECISION=7'])
+
+def geojson_feature(geometry_json, properties, fid):
+    ''' Return a GeoJSON string for geometry JSON, properties, and feature ID.
+    '''
+    if fid == ogr.NullFID:
+        id_json = ''
+    else:
+        id_json = ', "id": {}'.format(fid)
     
-    return new_feature
+    return '{{"type": "Feature", "geometry": {}, "properties": {}{}}}'.format(
+        geometry_json, json.dumps(properties), id_json)
+
+# Per-process OGR layer, its transformation to EPSG:4326, and created tile
+# directories, set up lazily by process_tile()
+_worker = dict()
+
+def open_layer(filename):
+    ''' Return an OGR datasource and its first layer, with fraction and area fields added.
+    '''
+    ds = ogr.Open(filename)
+    layer = ds.GetLayer(0)
+    
+    layer_defn = layer.GetLayerDefn()
+    layer_defn.AddFieldDefn(ogr.FieldDefn(FRACTION_FIELD, ogr.OFTReal))
+    layer_defn.AddFieldDefn(ogr.FieldDefn(AREA_FIELD, ogr.OFTReal))
+    
+    return ds, layer
+
+@functools.lru_cache(maxsize=10000)
+def cached_feature(filename, fid):
+    ''' Return a feature from the per-process layer, reading each one only once.
+    
+        Features straddling tile edges are wanted by several neighboring
+        tiles, which Hilbert ordering tends to send to the same worker.
+        Geometry is transformed to EPSG:4326 here so tiles can clip it with
+        no further reprojection, and invalid polygons are repaired with a tiny
+        buffer so scoring rarely needs to recover from GEOS topology errors.
+        Callers must treat returned features and geometries as read-only.
+    '''
+    feature = _worker['layer'].GetFeature(fid)
+    geometry = feature.GetGeometryRef()
+    
+    if geometry is None:
+        return feature
+    
+    if _worker['transform'] is not None:
+        geometry.Transform(_worker['transform'])
+    
+    if geometry.GetGeometryType() in POLYGON_TYPES and not geometry.IsValid():
+        feature.SetGeometryDirectly(geometry.Buffer(0.0000001))
+    
+    return feature
+
+def layer_transform(layer):
+    ''' Return an OSR transformation from layer projection to EPSG:4326, or None.
+    '''
+    layer_srs = layer.GetSpatialRef()
+    
+    if layer_srs is None:
+        return None
+    
+    return osr.CoordinateTransformation(layer_srs, EPSG4326)
+
+def process_tile(tile, x1, y1, x2, y2, filename, directory, use_s3, fids):
+    ''' Excerpt features for a single tile.
+    
+        OGR datasources are not safe to share across forked processes, so
+        each worker opens its own on first use. Candidate feature IDs for the
+        tile come from index_layer_tiles().
+        
+        Returns None for an empty tile, or a tuple with the tile key and a
+        gzipped body for S3 or None after writing to a local file.
+    '''
+    if _worker.get('filename') != filename:
+        _worker['ds'], _worker['layer'] = open_layer(filename)
+        _worker['transform'] = layer_transform(_worker['layer'])
+        _worker['filename'] = filename
+        cached_feature.cache_clear()
+    
+    layer = _worker['layer']
+    
+    bbox_geom, bbox_xxyy = bbox_geometry(x1, y1, x2, y2), (x1, x2, y1, y2)
+    
+    # Cached features are already in EPSG:4326, same as the tile bbox
+    features = iter_tile_features(layer, fids, bbox_geom, bbox_xxyy,
+        functools.partial(cached_feature, filename))
+    
+    layer_defn = layer.GetLayerDefn()
+    field_names = [layer_defn.GetFieldDefn(i).GetName() for i in range(layer_defn.GetFieldCount())]
+    
+    features_json = (excerpt_feature_json(feature, field_names, bbox_geom,
+        bbox_xxyy).encode('utf8') for feature in features)
+    
+    first_json = next(features_json, None)
+    
+    if first_json is None:
+        return None
+    
+    tile_zxy = f'{tile.zoom}/{tile.column}/{tile.row}'
+    key = KEY_FORMAT.format(directory=directory, zxy=tile_zxy)
+    
+    if use_s3:
+        body_buffer = io.BytesIO()
+        
+        # Fastest compression level, barely larger than default for JSON
+        with gzip.GzipFile(fileobj=body_buffer, mode='wb', compresslevel=1) as gzfile:
+            with io.BufferedWriter(gzfile, buffer_size=8192) as file:
+                write_feature_collection(file, first_json, features_json)
+        
+        return key, body_buffer.getvalue()
+    else:
+        dirname = os.path.dirname(key)
+        
+        if dirname not in _worker.setdefault('dirnames', set()):
+            os.makedirs(dirname, exist_ok=True)
+            _worker['dirnames'].add(dirname)
+
+        with open(key, 'wb') as file:
+            write_feature_collection(file, first_json, features_json)
+
+        return key, None
+
+def upload_tile(s3, key, body):
+    ''' Upload a gzipped tile body to S3 and return a short description.
+    '''
+    s3.upload_fileobj(io.BytesIO(body), constants.S3_BUCKET, key, Config=TRANSFER_CONFIG,
+        ExtraArgs=dict(ContentEncoding='gzip', ContentType='text/json', ACL='public-read'))
+
+    return '{} - {:.1f}KB'.format(key, len(body) / 1024)
+
+def write_feature_collection(file, first_json, more_json):
+    ''' Write encoded GeoJSON features to a file as they arrive.
+    
+        Features are streamed into the file to avoid holding extra
+        copies of a complete tile in memory.
+    '''
+    file.write(b'{"type": "FeatureCollection", "features": [\n')
+    file.write(first_json)
+    
+    for feature_json in more_json:
+        file.write(b',\n')
+        file.write(feature_json)
+    
+    file.write(b'\n]}\n')
+
+def _process_tile_args(args):
+    return process_tile(*args)
 
 parser = argparse.ArgumentParser(description='YESS')
 
@@ -70,47 +364,65 @@ parser.add_argument('--zoom', type=int, default=TILE_ZOOM,
     help='Zoom level. Default {}.'.format(TILE_ZOOM))
 parser.add_argument('--s3', action='store_true',
     help='Upload to S3 instead of local directory')
+parser.add_argument('--processes', type=int, default=os.cpu_count(),
+    help='Number of parallel tile processes. Default {}.'.format(os.cpu_count()))
 
 def main():
     args = parser.parse_args()
-    s3 = boto3.client('s3') if args.s3 else None
-
+    
     ds = ogr.Open(args.filename)
     layer = ds.GetLayer(0)
+    tile_fids = index_layer_tiles(layer, args.zoom, layer_transform(layer))
     
-    layer_defn = layer.GetLayerDefn()
-    layer_defn.AddFieldDefn(ogr.FieldDefn(FRACTION_FIELD, ogr.OFTReal))
+    if not tile_fids:
+        return
     
-    for (tile, bbox_wkt) in iter_extent_tiles(layer.GetExtent(), args.zoom):
-        bbox_geom = ogr.CreateGeometryFromWkt(bbox_wkt)
-        layer.SetSpatialFilter(bbox_geom)
-        
-        features_json = []
+    # Enumerate tiles over the indexed EPSG:4326 extent, because the layer
+    # extent may be in some other projection.
+    rows, columns = zip(*tile_fids.keys())
+    tiles_extent = (tile_longitude(min(columns), args.zoom), tile_longitude(max(columns) + 1, args.zoom),
+        tile_latitude(max(rows) + 1, args.zoom), tile_latitude(min(rows), args.zoom))
     
-        for feature in layer:
-            features_json.append(excerpt_feature(feature, bbox_geom)
-                .ExportToJson(options=['COORDINATE_PRECISION=7']))
-        
-        if not features_json:
-            continue
+    # Tiles with no indexed features are skipped entirely, and the rest are
+    # visited along a Hilbert curve so that neighboring tiles sharing source
+    # features are read close together and land in the same worker chunks.
+    tile_bboxes = sorted((tile_bbox for tile_bbox
+        in iter_extent_tiles(tiles_extent, args.zoom)
+        if (tile_bbox[0].row, tile_bbox[0].column) in tile_fids),
+        key=lambda tile_bbox: hilbert_distance(tile_bbox[0].row, tile_bbox[0].column, args.zoom))
     
-        buffer = io.StringIO()
-        print('{"type": "FeatureCollection", "features": [', file=buffer)
-        print(',\n'.join(features_json), file=buffer)
-        print(']}', file=buffer)
-        
-        tile_zxy = '{zoom}/{column}/{row}'.format(**tile.__dict__)
-        key = KEY_FORMAT.format(directory=args.directory, zxy=tile_zxy)
+    tile_args = (tile_bbox + (args.filename, args.directory, args.s3,
+        tile_fids[(tile_bbox[0].row, tile_bbox[0].column)])
+        for tile_bbox in tile_bboxes)
+    
+    s3, uploads = boto3.client('s3') if args.s3 else None, set()
+    
+    # Tiles are computed in worker processes while uploads run here in
+    # threads, so network latency overlaps with work on the next tiles.
+    # In-flight uploads are capped so gzipped bodies can't pile up in memory.
+    with multiprocessing.Pool(processes=args.processes) as pool, \
+        concurrent.futures.ThreadPoolExecutor(max_workers=MAX_UPLOADS) as executor:
+        for result in pool.imap_unordered(_process_tile_args, tile_args, chunksize=8):
+            if result is None:
+                continue
+            
+            key, body = result
+            
+            if body is None:
+                print(key)
+                continue
+            
+            if len(uploads) >= MAX_UPLOADS:
+                done, uploads = concurrent.futures.wait(uploads,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+            else:
+                done = {upload for upload in uploads if upload.done()}
+                uploads -= done
+            
+            for upload in done:
+                print(upload.result())
+            
+            uploads.add(executor.submit(upload_tile, s3, key, body))
         
-        if args.s3:
-            body = gzip.compress(buffer.getvalue().encode('utf8'))
-            print(key, '-', '{:.1f}KB'.format(len(body) / 1024))
-    
-            s3.put_object(Bucket=constants.S3_BUCKET, Key=key, Body=body,
-                ContentEncoding='gzip', ContentType='text/json', ACL='public-read')
-        else:
-            os.makedirs(os.path.dirname(key), exist_ok=True)
-            print(key)
-    
-            with open(key, 'w') as file:
-                file.write(buffer.getvalue())
+        for upload in concurrent.futures.as_completed(uploads):
+            print(upload.result())
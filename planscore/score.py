@@ -3,7 +3,7 @@
 When all districts are added up and present on S3, performs complete scoring
 of district plan and uploads summary JSON file.
 '''
-import io, os, gzip, posixpath, json, statistics, copy, time, itertools
+import io, os, gzip, posixpath, json, statistics, copy, time, itertools, functools
 from osgeo import ogr
 import boto3, botocore.exceptions
 from . import data, constants
@@ -54,6 +54,16 @@ FIELD_NAMES += tuple([f'DEM{sim:03d}' for sim in range(1000)])
 
 FUNCTION_NAME = 'PlanScore-ScoreDistrictPlan'
 
+@functools.lru_cache(maxsize=128)
+def scored_field_names(property_names):
+    ''' Return FIELD_NAMES found in a tuple of property names, in order.
+    
+        Precincts from one plan share the same handful of properties, so this
+        avoids checking all two thousand-odd field names for each precinct.
+    '''
+    property_names = set(property_names)
+    return tuple(name for name in FIELD_NAMES if name in property_names)
+
 def swing_vote(red_districts, blue_districts, amount):
     ''' Swing the vote by a percentage, positive toward blue.
     '''
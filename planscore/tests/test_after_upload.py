@@ -184,7 +184,12 @@ class TestAfterUpload (unittest.TestCase):
         upload = data.Upload('ID', 'uploads/ID/upload/file.geojson')
         null_plan_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan.geojson')
         keys = after_upload.put_district_geometries(s3, 'bucket-name', upload, null_plan_path)
-        self.assertEqual(keys, ['uploads/ID/geometries/0.wkt', 'uploads/ID/geometries/1.wkt'])
+        self.assertEqual(keys, ['uploads/ID/geometries/0.wkb', 'uploads/ID/geometries/1.wkb'])
+        
+        for (key, call) in zip(keys, s3.put_object.mock_calls):
+            self.assertEqual(call[2]['Key'], key)
+            self.assertEqual(call[2]['Body'][:1], b'\x01', 'Should be little-endian WKB')
+            self.assertIsNotNone(ogr.CreateGeometryFromWkb(call[2]['Body']))
     
     def test_load_model_tiles(self):
         '''
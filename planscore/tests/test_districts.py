@@ -1,4 +1,4 @@
-import unittest, unittest.mock, os, json, io, gzip, itertools
+import unittest, unittest.mock, os, json, io, gzip, itertools, base64, pickle, tempfile, shutil
 from osgeo import ogr
 import botocore.exceptions
 from .. import districts, data, score
@@ -52,6 +52,37 @@ class TestDistricts (unittest.TestCase):
         self.assertFalse(partial.contains_tile('12/2047/2048'),
             'Large tile overlaps district')
     
+    def test_Partial_contains_tile_crossings(self):
+        ''' Partial.contains_tile() counts crossings for tiles away from edges.
+        '''
+        # Square district with a square hole in the middle
+        partial = districts.Partial(0, {}, None, None, None, None, None,
+            ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,1 1,1 -1,-1 -1),(-.8 -.8,.8 -.8,.8 .8,-.8 .8,-.8 -.8))'))
+        
+        with unittest.mock.patch('osgeo.ogr.Geometry.Contains') as Contains:
+            self.assertTrue(partial.contains_tile('12/2058/2047'), 'Tile should be in the district ring')
+            self.assertFalse(partial.contains_tile('12/2048/2047'), 'Tile should be in the hole')
+            self.assertTrue(partial.contains_tile('12/2037/2050'), 'Tile should be in the district ring')
+        
+        self.assertEqual(len(Contains.mock_calls), 0)
+        self.assertIn(12, partial._row_crossings)
+    
+    def test_tile_row_crossings(self):
+        ''' Correct crossings are returned from tile_row_crossings().
+        '''
+        geometry = ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,1 1,1 -1,-1 -1),(-.8 -.8,.8 -.8,.8 .8,-.8 .8,-.8 -.8))')
+        crossings = districts.tile_row_crossings(geometry, 8)
+        
+        self.assertEqual(sorted(crossings.keys()), [127, 128])
+        self.assertEqual(crossings[127], [-1, -.8, .8, 1])
+        self.assertEqual(crossings[128], [-1, -.8, .8, 1])
+        
+        self.assertFalse(districts.crossings_contain(crossings[127], -2))
+        self.assertTrue(districts.crossings_contain(crossings[127], -.9))
+        self.assertFalse(districts.crossings_contain(crossings[127], 0))
+        self.assertTrue(districts.crossings_contain(crossings[127], .9))
+        self.assertFalse(districts.crossings_contain(crossings[127], 2))
+    
     def test_Partial_tile_geometry(self):
         ''' Partial.tile_geometry() returns correct geometries.
         '''
@@ -83,6 +114,54 @@ class TestDistricts (unittest.TestCase):
         self.assertTrue(g6.Disjoint(partial.geometry),
             'Tiny tile should touch no part of district')
     
+    def test_Partial_tile_geometry_envelopes(self):
+        ''' Partial.tile_geometry() skips intersections for obvious tiles.
+        '''
+        partial = districts.Partial(0, {}, None, None, None, None, None,
+            ogr.CreateGeometryFromWkt('POLYGON ((0 0.0004532,-0.0006812 0.0002467,-0.0006356 -0.0003486,0 -0.0004693,0 0,0 0.0004532))'))
+        
+        with unittest.mock.patch('osgeo.ogr.Geometry.Intersection') as Intersection:
+            g1 = partial.tile_geometry('0/0/0')
+            g2 = partial.tile_geometry('8/129/127')
+        
+        self.assertIs(g1, partial.geometry, 'World tile should contain whole district')
+        self.assertTrue(g2.IsEmpty(), 'Distant tile should be empty')
+        self.assertFalse(Intersection.called)
+    
+    def test_EdgeGrid(self):
+        ''' EdgeGrid finds district edges near an envelope.
+        '''
+        grid = districts.EdgeGrid(ogr.CreateGeometryFromWkt(
+            'POLYGON ((0 0,0 4,4 4,4 0,0 0),(1 1,2 1,2 2,1 2,1 1))'))
+        
+        self.assertTrue(grid.intersects((-1, 1, 3, 3.5)), 'Should find outer ring')
+        self.assertTrue(grid.intersects((1.5, 1.7, 1.5, 3)), 'Should find inner ring')
+        self.assertFalse(grid.intersects((2.5, 3.5, 2.5, 3.5)), 'Should find no edges')
+        self.assertFalse(grid.intersects((1.2, 1.8, 1.2, 1.8)), 'Should find no edges in hole')
+    
+    def test_iter_geometry_edges(self):
+        ''' iter_geometry_edges() returns all ring segments.
+        '''
+        edges = list(districts.iter_geometry_edges(ogr.CreateGeometryFromWkt(
+            'MULTIPOLYGON (((0 0,0 1,1 1,0 0)),((2 2,2 3,3 3,2 2)))')))
+        
+        self.assertEqual(len(edges), 6)
+        self.assertEqual(edges[0], ((0, 0), (0, 1)))
+        self.assertEqual(edges[-1], ((3, 3), (2, 2)))
+    
+    def test_Partial_classify_tile(self):
+        ''' Partial.classify_tile() returns correct values.
+        '''
+        # District partial within the western hemisphere, touching the prime meridian
+        partial = districts.Partial(0, {}, None, None, None, None, None,
+            ogr.CreateGeometryFromWkt('POLYGON ((0 0.0004532,-0.0006812 0.0002467,-0.0006356 -0.0003486,0 -0.0004693,0 0,0 0.0004532))'))
+        
+        self.assertEqual(partial.classify_tile('20/524287/524287'), 'inside')
+        self.assertEqual(partial.classify_tile('20/524288/524287'), 'overlap')
+        self.assertEqual(partial.classify_tile('20/524289/524287'), 'outside')
+        self.assertEqual(partial.classify_tile('12/2047/2048'), 'overlap')
+        self.assertEqual(partial.classify_tile(None), 'overlap')
+    
     def test_Partial_to_event(self):
         ''' Partial.to_event() and .from_event() work together.
         '''
@@ -103,6 +182,29 @@ class TestDistricts (unittest.TestCase):
         self.assertEqual(partial2.compactness['Reock'], partial1.compactness['Reock'])
         self.assertEqual(partial2.tiles, partial1.tiles)
         self.assertEqual(str(partial2.geometry_key), str(partial1.geometry_key))
+        self.assertTrue(partial2.geometry.Equals(partial1.geometry))
+        self.assertFalse(storage.s3.get_object.called,
+            'Small geometry should be carried in the event instead of S3')
+    
+    def test_Partial_to_event_no_geometry(self):
+        ''' Partial.to_event() works without a geometry, as in district fan-out.
+        '''
+        storage = unittest.mock.Mock()
+        storage.s3.get_object.return_value = {'Body': io.BytesIO(b'POINT (0.00001 0.00001)')}
+        
+        partial1 = districts.Partial(0, None, None, None, None,
+            'uploads/ID/geometries/0.wkb', data.Upload('ID', 'key.json'), None)
+        
+        event = partial1.to_event()
+        self.assertNotIn('geometry_wkb', event)
+        
+        partial2 = districts.Partial.from_event(event, storage)
+        
+        self.assertEqual(partial2.index, partial1.index)
+        self.assertEqual(partial2.geometry_key, partial1.geometry_key)
+        self.assertEqual(str(partial2.geometry), 'POINT (0.00001 0.00001)')
+        storage.s3.get_object.assert_called_once_with(Bucket=storage.bucket,
+            Key='uploads/ID/geometries/0.wkb')
     
     def test_Partial_scrunching(self):
         ''' Partial.scrunch() and .unscrunch() work symmetrically.
@@ -116,6 +218,10 @@ class TestDistricts (unittest.TestCase):
                 value, 'Lists and dictionaries should unscrunch cleanly')
             self.assertEqual(districts.Partial.unscrunch(value), value,
                 'Lists and dictionaries should unscrunch to themselves')
+        
+        old_scrunched = base64.a85encode(gzip.compress(pickle.dumps(['Yo']))).decode('ascii')
+        self.assertEqual(districts.Partial.unscrunch(old_scrunched), ['Yo'],
+            'Values scrunched with default gzip and pickle settings should unscrunch')
     
     def test_tile_geometry(self):
         ''' Correct tile geometries are returned from tile_geometry().
@@ -132,6 +238,18 @@ class TestDistricts (unittest.TestCase):
         self.assertAlmostEqual(s2, 37.788081384120, 9)
         self.assertAlmostEqual(n2, 37.857507156252, 9)
 
+    def test_tile_envelope(self):
+        ''' Correct tile envelopes are returned from tile_envelope().
+        '''
+        w, e, s, n = districts.tile_envelope('12/656/1582')
+        self.assertAlmostEqual(w, -122.34375, 9)
+        self.assertAlmostEqual(e, -122.255859375, 9)
+        self.assertAlmostEqual(s, 37.788081384120, 9)
+        self.assertAlmostEqual(n, 37.857507156252, 9)
+        
+        self.assertEqual(districts.tile_geometry('12/656/1582').GetEnvelope(),
+            districts.tile_envelope('12/656/1582'))
+
     @unittest.mock.patch('sys.stdout')
     @unittest.mock.patch('boto3.client')
     @unittest.mock.patch('planscore.compactness.get_scores')
@@ -282,9 +400,18 @@ class TestDistricts (unittest.TestCase):
         
         districts.post_score_results(storage, partial)
 
-        storage.s3.put_object.assert_called_once_with(
-            ACL='bucket-owner-full-control', Body=b'{\n  "index": -1,\n  "totals": {\n    "Voters": 1\n  },\n  "compactness": {},\n  "precincts": 0,\n  "tiles": [],\n  "upload": {\n    "id": "ID",\n    "key": "uploads/ID/upload/file.geojson",\n    "model": null,\n    "districts": [\n      null,\n      null\n    ],\n    "summary": {},\n    "progress": null,\n    "start_time": -1,\n    "message": null\n  }\n}',
-            Bucket='bucket-name', ContentType='text/json', Key='uploads/ID/districts/-1.json')
+        self.assertEqual(storage.s3.put_object.call_count, 1)
+        kwargs = storage.s3.put_object.call_args[1]
+        body = kwargs.pop('Body')
+        
+        self.assertEqual(kwargs, dict(ACL='bucket-owner-full-control',
+            Bucket='bucket-name', ContentType='text/json', Key='uploads/ID/districts/-1.json'))
+        self.assertEqual(json.loads(body.decode('utf8')), {
+            "index": -1, "totals": {"Voters": 1}, "compactness": {}, "precincts": 0,
+            "tiles": [], "upload": {"id": "ID", "key": "uploads/ID/upload/file.geojson",
+            "model": None, "districts": [None, None], "summary": {}, "progress": None,
+            "start_time": -1, "message": None}})
+    
     @unittest.mock.patch('planscore.districts.get_tile_metadata')
     @unittest.mock.patch('planscore.districts.load_tile_precincts')
     @unittest.mock.patch('planscore.districts.score_precinct')
@@ -519,6 +646,36 @@ class TestDistricts (unittest.TestCase):
         districts.score_precinct(partial, blockpoint, '12/2059/2047')
         self.assertAlmostEqual(partial.totals['Voters'], 0., 9)
     
+    def test_score_precinct_far_outside(self):
+        ''' No geometry operations happen for a precinct beyond the district envelope.
+        '''
+        geometry = ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,0.11 1,0.11 -1,-1 -1))')
+        partial = districts.Partial(None, {'Voters': 0}, None, None, None, None, None, geometry)
+
+        precinct = {"type": "Feature", "properties": {"Voters": 1, "PlanScore:Fraction": 0.5}, "geometry": {"type": "Polygon", "coordinates": [[[.12, .12], [.12, .16], [.16, .16], [.16, .12], [.12, .12]]]}}
+        self.assertEqual(partial.classify_tile('12/2049/2046'), 'overlap')
+        
+        with unittest.mock.patch('osgeo.ogr.Geometry.Intersection') as Intersection:
+            districts.score_precinct(partial, precinct, '12/2049/2046')
+        
+        self.assertFalse(Intersection.called)
+        self.assertEqual(partial.totals['Voters'], 0)
+    
+    def test_score_precinct_blockpoint_no_geojson(self):
+        ''' Block-points are scored without parsing their GeoJSON geometry.
+        '''
+        geometry = ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,0.17 1,0.17 -1,-1 -1))')
+        partial = districts.Partial(None, {'Voters': 0}, None, None, None, None, None, geometry)
+        self.assertEqual(partial.classify_tile('12/2049/2046'), 'overlap')
+
+        blockpoint = {"type": "Feature", "properties": {"Voters": 1}, "geometry": {"type": "Point", "coordinates": [.14, .14]}}
+        
+        with unittest.mock.patch('osgeo.ogr.CreateGeometryFromJson') as CreateGeometryFromJson:
+            districts.score_precinct(partial, blockpoint, '12/2049/2046')
+        
+        self.assertFalse(CreateGeometryFromJson.called)
+        self.assertAlmostEqual(partial.totals['Voters'], 1, 9)
+    
     def test_score_precinct_7_empty(self):
         ''' Correct voter count for an empty geometry from tile within district.
         '''
@@ -584,6 +741,24 @@ class TestDistricts (unittest.TestCase):
         precincts2 = districts.load_tile_precincts(storage, '12/-1/-1')
         self.assertEqual(len(precincts2), 0)
 
+    def test_load_tile_precincts_cached(self):
+        ''' Tiles are read from S3 only once with a local cache directory.
+        '''
+        s3 = unittest.mock.Mock()
+        s3.get_object.side_effect = mock_s3_get_object
+        storage = data.Storage(s3, 'bucket-name', 'XX')
+        dirname = tempfile.mkdtemp(prefix='test_load_tile_precincts_cached-')
+
+        try:
+            with unittest.mock.patch('planscore.constants.TILE_CACHE_DIR', dirname):
+                precincts1 = districts.load_tile_precincts(storage, '12/2047/2047')
+                precincts2 = districts.load_tile_precincts(storage, '12/2047/2047')
+        finally:
+            shutil.rmtree(dirname)
+        
+        s3.get_object.assert_called_once_with(Bucket='bucket-name', Key='XX/12/2047/2047.geojson')
+        self.assertEqual(precincts1, precincts2)
+
     @unittest.mock.patch('sys.stdout')
     def test_get_geometry_tile_zxys(self, stdout):
         ''' Get an expected list of Z/X/Y tile strings for a geometry.
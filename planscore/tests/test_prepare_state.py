@@ -1,5 +1,5 @@
-import unittest
-from osgeo import ogr
+import unittest, unittest.mock, os, io, gzip, json, tempfile, shutil, itertools
+from osgeo import ogr, osr
 from .. import prepare_state
 
 class TestPrepareState (unittest.TestCase):
@@ -12,143 +12,481 @@ class TestPrepareState (unittest.TestCase):
         self.assertEqual(len(z8_tiles), 4)
         self.assertEqual(len(z9_tiles), 16)
         
-        z8_coord1, z8_wkt1 = z8_tiles[0]
-        z8_coord2, z8_wkt2 = z8_tiles[-1]
+        z8_coord1, *z8_bbox1 = z8_tiles[0]
+        z8_coord2, *z8_bbox2 = z8_tiles[-1]
         
         self.assertEqual((z8_coord1.zoom, z8_coord1.row, z8_coord1.column), (8, 127, 127))
         self.assertEqual((z8_coord2.zoom, z8_coord2.row, z8_coord2.column), (8, 128, 128))
-        self.assertIn('POLYGON', z8_wkt1)
-        self.assertIn('POLYGON', z8_wkt2)
+        self.assertAlmostEqual(z8_bbox1[0], -1.40625, 9)
+        self.assertAlmostEqual(z8_bbox1[3], 1.406108835, 9)
+        self.assertAlmostEqual(z8_bbox2[1], -1.406108835, 9)
+        self.assertAlmostEqual(z8_bbox2[2], 1.40625, 9)
     
-        z9_coord1, z9_wkt1 = z9_tiles[0]
-        z9_coord2, z9_wkt2 = z9_tiles[-1]
+        z9_coord1, *z9_bbox1 = z9_tiles[0]
+        z9_coord2, *z9_bbox2 = z9_tiles[-1]
         
         self.assertEqual((z9_coord1.zoom, z9_coord1.row, z9_coord1.column), (9, 254, 254))
         self.assertEqual((z9_coord2.zoom, z9_coord2.row, z9_coord2.column), (9, 257, 257))
-        self.assertIn('POLYGON', z9_wkt1)
-        self.assertIn('POLYGON', z9_wkt2)
+        self.assertEqual(len(z9_bbox1), 4)
+        self.assertEqual(len(z9_bbox2), 4)
     
-    def test_excerpt_feature_within(self):
-        ''' excerpt_feature() works with a contained polygon.
+    def test_tile_longitude_latitude(self):
+        ''' tile_longitude() and tile_latitude() return spherical mercator tile edges.
         '''
-        bbox_geom = ogr.CreateGeometryFromJson('{"type": "Polygon", '
-            '"coordinates": [[[0, 0], [0, 3], [3, 3], [3, 0], [0, 0]]]}')
-        bbox_geom.AssignSpatialReference(prepare_state.EPSG4326)
+        self.assertAlmostEqual(prepare_state.tile_longitude(0, 0), -180, 9)
+        self.assertAlmostEqual(prepare_state.tile_longitude(1, 0), 180, 9)
+        self.assertAlmostEqual(prepare_state.tile_latitude(0, 0), 85.051128780, 9)
+        self.assertAlmostEqual(prepare_state.tile_latitude(1, 0), -85.051128780, 9)
+        
+        self.assertAlmostEqual(prepare_state.tile_longitude(656, 12), -122.34375, 9)
+        self.assertAlmostEqual(prepare_state.tile_longitude(657, 12), -122.255859375, 9)
+        self.assertAlmostEqual(prepare_state.tile_latitude(1582, 12), 37.857507156252, 9)
+        self.assertAlmostEqual(prepare_state.tile_latitude(1583, 12), 37.788081384120, 9)
+    
+    def test_tile_column_row(self):
+        ''' tile_column() and tile_row() invert tile_longitude() and tile_latitude().
+        '''
+        self.assertAlmostEqual(prepare_state.tile_column(-122.34375, 12), 656, 9)
+        self.assertAlmostEqual(prepare_state.tile_row(37.857507156252, 12), 1582, 6)
+        self.assertAlmostEqual(prepare_state.tile_column(0, 12), 2048, 9)
+        self.assertAlmostEqual(prepare_state.tile_row(0, 12), 2048, 9)
+    
+    def test_hilbert_distance(self):
+        ''' hilbert_distance() orders tiles along a continuous curve.
+        '''
+        z1_tiles = sorted(itertools.product(range(2), range(2)),
+            key=lambda rc: prepare_state.hilbert_distance(rc[0], rc[1], 1))
+        
+        self.assertEqual(z1_tiles, [(0, 0), (1, 0), (1, 1), (0, 1)])
+        
+        z4_distances = {prepare_state.hilbert_distance(row, col, 4): (row, col)
+            for (row, col) in itertools.product(range(16), range(16))}
+        
+        self.assertEqual(sorted(z4_distances), list(range(256)))
+        
+        for distance in range(255):
+            (row1, col1), (row2, col2) = z4_distances[distance], z4_distances[distance + 1]
+            self.assertEqual(abs(row1 - row2) + abs(col1 - col2), 1,
+                'Consecutive tiles should be neighbors')
+    
+    def test_index_layer_tiles(self):
+        ''' index_layer_tiles() lists feature IDs under each touched tile.
+        '''
+        filename = os.path.join(os.path.dirname(__file__), 'data', 'null-plan.geojson')
+        ds = ogr.Open(filename)
+        tile_fids = prepare_state.index_layer_tiles(ds.GetLayer(0), 12)
+        
+        self.assertEqual(dict(tile_fids), {(2047, 2047): [0, 1], (2048, 2047): [0, 1],
+            (2047, 2048): [1], (2048, 2048): [1]})
+    
+    def test_index_layer_tiles_transform(self):
+        ''' index_layer_tiles() indexes reprojected envelopes given a transformation.
+        '''
+        epsg3857 = osr.SpatialReference(); epsg3857.ImportFromEPSG(3857)
+        transform = osr.CoordinateTransformation(epsg3857, prepare_state.EPSG4326)
+        
+        ds = ogr.GetDriverByName('Memory').CreateDataSource('')
+        layer = ds.CreateLayer('', epsg3857, ogr.wkbPolygon)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(ogr.CreateGeometryFromWkt('POLYGON ((100000 100000,100000 300000,'
+            '300000 300000,300000 100000,100000 100000))'))
+        layer.CreateFeature(feature)
+        
+        geometry = feature.GetGeometryRef().Clone()
+        geometry.Transform(transform)
+        expected_tiles = {(coord.row, coord.column) for (coord, *_)
+            in prepare_state.iter_extent_tiles(geometry.GetEnvelope(), 12)}
+        
+        tile_fids = prepare_state.index_layer_tiles(layer, 12, transform)
+        
+        self.assertEqual(set(tile_fids.keys()), expected_tiles)
+        self.assertEqual({tuple(fids) for fids in tile_fids.values()}, {(feature.GetFID(), )})
+    
+    def test_bbox_geometry(self):
+        ''' bbox_geometry() returns a rectangular polygon.
+        '''
+        bbox_geom = prepare_state.bbox_geometry(-1, -2, 3, 4)
+        
+        self.assertEqual(bbox_geom.GetGeometryType(), ogr.wkbPolygon)
+        self.assertEqual(bbox_geom.GetEnvelope(), (-1, 3, -2, 4))
+        self.assertEqual(bbox_geom.GetArea(), 24)
+    
+    def test_envelope_contains(self):
+        ''' envelope_contains() compares (xmin, xmax, ymin, ymax) envelopes.
+        '''
+        self.assertTrue(prepare_state.envelope_contains((0, 3, 0, 3), (1, 2, 1, 2)))
+        self.assertTrue(prepare_state.envelope_contains((0, 3, 0, 3), (0, 3, 0, 3)))
+        self.assertFalse(prepare_state.envelope_contains((0, 2, 0, 2), (1, 3, 1, 3)))
+        self.assertFalse(prepare_state.envelope_contains((0, 1, 0, 1), (2, 3, 2, 3)))
+    
+    def test_envelopes_disjoint(self):
+        ''' envelopes_disjoint() compares (xmin, xmax, ymin, ymax) envelopes.
+        '''
+        self.assertTrue(prepare_state.envelopes_disjoint((0, 1, 0, 1), (2, 3, 0, 1)))
+        self.assertTrue(prepare_state.envelopes_disjoint((0, 1, 0, 1), (0, 1, -2, -1)))
+        self.assertFalse(prepare_state.envelopes_disjoint((0, 1, 0, 1), (1, 2, 1, 2)))
+        self.assertFalse(prepare_state.envelopes_disjoint((0, 2, 0, 2), (.5, 1, .5, 1)))
+    
+    def test_write_feature_collection(self):
+        ''' write_feature_collection() writes a complete GeoJSON collection.
+        '''
+        file = io.BytesIO()
+        features = [b'{"type": "Feature", "properties": {"n": 2}, "geometry": null}',
+            b'{"type": "Feature", "properties": {"n": 3}, "geometry": null}']
+        
+        prepare_state.write_feature_collection(file,
+            b'{"type": "Feature", "properties": {"n": 1}, "geometry": null}', iter(features))
+        
+        geojson = json.loads(file.getvalue().decode('utf8'))
+        self.assertEqual(geojson['type'], 'FeatureCollection')
+        self.assertEqual([f['properties']['n'] for f in geojson['features']], [1, 2, 3])
+    
+    def test_geojson_feature(self):
+        ''' geojson_feature() matches output of ogr.Feature.ExportToJson().
+        '''
+        feature_defn = ogr.FeatureDefn()
+        feature_defn.AddFieldDefn(ogr.FieldDefn('Population', ogr.OFTInteger))
+        feature_defn.AddFieldDefn(ogr.FieldDefn(prepare_state.FRACTION_FIELD, ogr.OFTReal))
+        
+        feature = ogr.Feature(feature_defn)
+        feature.SetField('Population', 999)
+        feature.SetField(prepare_state.FRACTION_FIELD, .5)
+        feature.SetGeometry(ogr.CreateGeometryFromJson('{"type": "Polygon", '
+            '"coordinates": [[[1, 1], [1, 2], [2, 2.00000001], [2, 1], [1, 1]]]}'))
+        
+        properties = {'Population': 999, prepare_state.FRACTION_FIELD: .5}
+        geometry_json = prepare_state.export_geometry_json(feature.GetGeometryRef())
+        expected = json.loads(feature.ExportToJson(options=['COORDINATE_PRECISION=7']))
+        
+        self.assertEqual(json.loads(prepare_state.geojson_feature(geometry_json, properties, ogr.NullFID)), expected)
+        self.assertEqual(expected['geometry']['coordinates'][0][2], [2, 2])
+        
+        feature.SetFID(7)
+        expected = json.loads(feature.ExportToJson(options=['COORDINATE_PRECISION=7']))
+        
+        self.assertEqual(json.loads(prepare_state.geojson_feature(geometry_json, properties, 7)), expected)
+        self.assertEqual(expected['id'], 7)
+    
+    def test_excerpt_feature_json_area(self):
+        ''' excerpt_feature_json() records area only for polygons with an area field.
+        '''
+        bbox_geom = prepare_state.bbox_geometry(0, 0, 2, 2)
+        
+        feature_defn = ogr.FeatureDefn()
+        feature_defn.AddFieldDefn(ogr.FieldDefn('Population', ogr.OFTInteger))
+        feature_defn.AddFieldDefn(ogr.FieldDefn(prepare_state.FRACTION_FIELD, ogr.OFTReal))
+        feature_defn.AddFieldDefn(ogr.FieldDefn(prepare_state.AREA_FIELD, ogr.OFTReal))
+        
+        for (geometry_json, area) in (('{"type": "Polygon", "coordinates": [[[1, 1], [1, 3], [3, 3], [3, 1], [1, 1]]]}', 1),
+            ('{"type": "Point", "coordinates": [1, 1]}', None)):
+            feature = ogr.Feature(feature_defn)
+            feature.SetField('Population', 999)
+            feature.SetGeometry(ogr.CreateGeometryFromJson(geometry_json))
+            
+            field_names = ['Population', prepare_state.FRACTION_FIELD]
+            geojson = json.loads(prepare_state.excerpt_feature_json(feature, field_names, bbox_geom))
+            self.assertNotIn(prepare_state.AREA_FIELD, geojson['properties'])
+            
+            field_names.append(prepare_state.AREA_FIELD)
+            geojson = json.loads(prepare_state.excerpt_feature_json(feature, field_names, bbox_geom))
+            self.assertEqual(geojson['properties']['Population'], 999)
+            self.assertEqual(geojson['properties'][prepare_state.AREA_FIELD], area)
+    
+    def test_excerpt_feature_json_rounded_area(self):
+        ''' excerpt_feature_json() records the area of its rounded geometry.
+        '''
+        bbox_geom = prepare_state.bbox_geometry(0, 0, 2, 2)
+        
+        feature_defn = ogr.FeatureDefn()
+        feature_defn.AddFieldDefn(ogr.FieldDefn(prepare_state.FRACTION_FIELD, ogr.OFTReal))
+        feature_defn.AddFieldDefn(ogr.FieldDefn(prepare_state.AREA_FIELD, ogr.OFTReal))
+        field_names = [prepare_state.FRACTION_FIELD, prepare_state.AREA_FIELD]
+        
+        feature = ogr.Feature(feature_defn)
+        feature.SetGeometry(ogr.CreateGeometryFromWkt('POLYGON ((0.123456789 0.123456789,'
+            '0.123456789 0.987654321,0.987654321 0.987654321,0.987654321 0.123456789,0.123456789 0.123456789))'))
+        
+        geojson = json.loads(prepare_state.excerpt_feature_json(feature, field_names, bbox_geom))
+        rounded_geometry = ogr.CreateGeometryFromJson(json.dumps(geojson['geometry']))
+        
+        self.assertEqual(geojson['properties'][prepare_state.AREA_FIELD], rounded_geometry.GetArea())
+    
+    def test_excerpt_feature_json_within(self):
+        ''' excerpt_feature_json() works with a contained polygon.
+        '''
+        bbox_geom = prepare_state.bbox_geometry(0, 0, 3, 3)
         
-        field_defn = ogr.FieldDefn('Population', ogr.OFTInteger)
         feature_defn = ogr.FeatureDefn()
-        feature_defn.AddFieldDefn(field_defn)
+        feature_defn.AddFieldDefn(ogr.FieldDefn('Population', ogr.OFTInteger))
         feature_defn.AddFieldDefn(ogr.FieldDefn(prepare_state.FRACTION_FIELD, ogr.OFTReal))
+        field_names = ['Population', prepare_state.FRACTION_FIELD]
         
         feature = ogr.Feature(feature_defn)
         feature.SetField('Population', 999)
+        feature.SetGeometry(ogr.CreateGeometryFromJson('{"type": "Polygon", '
+            '"coordinates": [[[1, 1], [1, 2], [2, 2], [2, 1], [1, 1]]]}'))
+        
+        geojson = json.loads(prepare_state.excerpt_feature_json(feature, field_names, bbox_geom))
+        geometry_e = ogr.CreateGeometryFromJson(json.dumps(geojson['geometry']))
+        
+        self.assertEqual(geojson['properties']['Population'], 999)
+        self.assertEqual(geojson['properties'][prepare_state.FRACTION_FIELD], 1)
+        self.assertEqual(geometry_e.GetArea(), 1)
+        
+    def test_excerpt_geometry_within_envelope(self):
+        ''' excerpt_geometry() skips intersection for a polygon within a known bbox envelope.
+        '''
+        bbox_geom = unittest.mock.Mock()
         geometry = ogr.CreateGeometryFromJson('{"type": "Polygon", '
             '"coordinates": [[[1, 1], [1, 2], [2, 2], [2, 1], [1, 1]]]}')
-        geometry.AssignSpatialReference(prepare_state.EPSG4326)
+        
+        geometry_e, fraction = prepare_state.excerpt_geometry(geometry, bbox_geom, (0, 3, 0, 3))
+        
+        self.assertEqual(len(bbox_geom.mock_calls), 0)
+        self.assertEqual(fraction, 1)
+        self.assertEqual(geometry_e.GetArea(), 1)
+        
+    def test_cached_feature_transform(self):
+        ''' cached_feature() reprojects with the worker transformation.
+        '''
+        epsg3857 = osr.SpatialReference(); epsg3857.ImportFromEPSG(3857)
+        
+        feature_defn = ogr.FeatureDefn()
+        feature = ogr.Feature(feature_defn)
+        geometry = ogr.CreateGeometryFromJson('{"type": "Polygon", '
+            '"coordinates": [[[100000, 100000], [100000, 300000], [300000, 300000], [300000, 100000], [100000, 100000]]]}')
+        geometry.AssignSpatialReference(epsg3857)
         feature.SetGeometry(geometry)
         
-        feature_e = prepare_state.excerpt_feature(feature, bbox_geom)
+        layer = unittest.mock.Mock()
+        layer.GetFeature.return_value = feature
+        
+        prepare_state._worker.clear()
+        prepare_state._worker.update(layer=layer,
+            transform=osr.CoordinateTransformation(epsg3857, prepare_state.EPSG4326))
+        prepare_state.cached_feature.cache_clear()
+        
+        try:
+            feature_c = prepare_state.cached_feature('transform.shp', 0)
+        finally:
+            prepare_state._worker.clear()
+            prepare_state.cached_feature.cache_clear()
+        
+        bbox_geom = prepare_state.bbox_geometry(0, 0, 1.796630568, 3)
+        geometry_e, fraction = prepare_state.excerpt_geometry(feature_c.GetGeometryRef(), bbox_geom)
+        xmin, xmax, ymin, ymax = geometry_e.GetEnvelope()
         
-        self.assertEqual(feature_e.GetField('Population'), feature.GetField('Population'))
-        self.assertEqual(feature_e.GetField(prepare_state.FRACTION_FIELD), 1)
-        self.assertEqual(feature_e.GetGeometryRef().GetArea(), 1)
+        self.assertEqual(layer.GetFeature.mock_calls, [unittest.mock.call(0)])
+        self.assertAlmostEqual(fraction, .5, 6)
+        self.assertAlmostEqual(xmin, 0.898315284, 6)
+        self.assertAlmostEqual(xmax, 1.796630568, 6)
         
-    def test_excerpt_feature_overlaps(self):
-        ''' excerpt_feature() works with an overlapping polygon.
+    def test_excerpt_geometry(self):
+        ''' excerpt_geometry() leaves coordinates alone while trimming.
         '''
-        bbox_geom = ogr.CreateGeometryFromJson('{"type": "Polygon", '
-            '"coordinates": [[[0, 0], [0, 2], [2, 2], [2, 0], [0, 0]]]}')
-        bbox_geom.AssignSpatialReference(prepare_state.EPSG4326)
+        bbox_geom = prepare_state.bbox_geometry(0, 0, 2, 2)
+        geometry = ogr.CreateGeometryFromJson('{"type": "Polygon", '
+            '"coordinates": [[[1, 1], [1, 3], [3, 3], [3, 1], [1, 1]]]}')
+        
+        geometry_e, fraction = prepare_state.excerpt_geometry(geometry, bbox_geom)
+        
+        self.assertEqual(fraction, .25)
+        self.assertEqual(geometry_e.GetEnvelope(), (1, 2, 1, 2))
+        self.assertIsNone(geometry_e.GetSpatialReference())
+        
+    def test_cached_feature_invalid(self):
+        ''' cached_feature() repairs an invalid polygon before any tile clips it.
+        '''
+        feature = ogr.Feature(ogr.FeatureDefn())
+        feature.SetGeometry(ogr.CreateGeometryFromJson('{"type": "Polygon", '
+            '"coordinates": [[[0, 0], [1, 1], [1, 0], [0, 1], [0, 0]]]}'))
+        self.assertFalse(feature.GetGeometryRef().IsValid())
+        
+        layer = unittest.mock.Mock()
+        layer.GetFeature.return_value = feature
+        
+        prepare_state._worker.clear()
+        prepare_state._worker.update(layer=layer, transform=None)
+        prepare_state.cached_feature.cache_clear()
+        
+        try:
+            geometry_c = prepare_state.cached_feature('invalid.shp', 0).GetGeometryRef()
+        finally:
+            prepare_state._worker.clear()
+            prepare_state.cached_feature.cache_clear()
+        
+        bbox_geom = prepare_state.bbox_geometry(0, 0, 2, 2)
+        geometry_e, fraction = prepare_state.excerpt_geometry(geometry_c, bbox_geom)
+        
+        self.assertTrue(geometry_c.IsValid())
+        self.assertTrue(geometry_e.IsValid())
+        self.assertGreater(geometry_e.GetArea(), 0)
+        self.assertAlmostEqual(fraction, 1, 9)
+        
+    def test_excerpt_feature_json_overlaps(self):
+        ''' excerpt_feature_json() works with an overlapping polygon.
+        '''
+        bbox_geom = prepare_state.bbox_geometry(0, 0, 2, 2)
         
-        field_defn = ogr.FieldDefn('Population', ogr.OFTInteger)
         feature_defn = ogr.FeatureDefn()
-        feature_defn.AddFieldDefn(field_defn)
+        feature_defn.AddFieldDefn(ogr.FieldDefn('Population', ogr.OFTInteger))
         feature_defn.AddFieldDefn(ogr.FieldDefn(prepare_state.FRACTION_FIELD, ogr.OFTReal))
+        field_names = ['Population', prepare_state.FRACTION_FIELD]
         
         feature = ogr.Feature(feature_defn)
         feature.SetField('Population', 999)
-        geometry = ogr.CreateGeometryFromJson('{"type": "Polygon", '
-            '"coordinates": [[[1, 1], [1, 3], [3, 3], [3, 1], [1, 1]]]}')
-        geometry.AssignSpatialReference(prepare_state.EPSG4326)
-        feature.SetGeometry(geometry)
+        feature.SetGeometry(ogr.CreateGeometryFromJson('{"type": "Polygon", '
+            '"coordinates": [[[1, 1], [1, 3], [3, 3], [3, 1], [1, 1]]]}'))
         
-        feature_e = prepare_state.excerpt_feature(feature, bbox_geom)
+        geojson = json.loads(prepare_state.excerpt_feature_json(feature, field_names, bbox_geom))
+        geometry_e = ogr.CreateGeometryFromJson(json.dumps(geojson['geometry']))
         
-        self.assertEqual(feature_e.GetField('Population'), feature.GetField('Population'))
-        self.assertEqual(feature_e.GetField(prepare_state.FRACTION_FIELD), .25)
-        self.assertEqual(feature_e.GetGeometryRef().GetArea(), 1)
+        self.assertEqual(geojson['properties']['Population'], 999)
+        self.assertEqual(geojson['properties'][prepare_state.FRACTION_FIELD], .25)
+        self.assertEqual(geometry_e.GetArea(), 1)
         
-    def test_excerpt_feature_touches(self):
-        ''' excerpt_feature() works with a touching polygon.
+    def test_excerpt_feature_json_touches(self):
+        ''' excerpt_feature_json() works with a touching polygon.
         '''
-        bbox_geom = ogr.CreateGeometryFromJson('{"type": "Polygon", '
-            '"coordinates": [[[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]]]}')
-        bbox_geom.AssignSpatialReference(prepare_state.EPSG4326)
+        bbox_geom = prepare_state.bbox_geometry(0, 0, 1, 1)
         
-        field_defn = ogr.FieldDefn('Population', ogr.OFTInteger)
         feature_defn = ogr.FeatureDefn()
-        feature_defn.AddFieldDefn(field_defn)
+        feature_defn.AddFieldDefn(ogr.FieldDefn('Population', ogr.OFTInteger))
         feature_defn.AddFieldDefn(ogr.FieldDefn(prepare_state.FRACTION_FIELD, ogr.OFTReal))
+        field_names = ['Population', prepare_state.FRACTION_FIELD]
         
         feature = ogr.Feature(feature_defn)
         feature.SetField('Population', 999)
-        geometry = ogr.CreateGeometryFromJson('{"type": "Polygon", '
-            '"coordinates": [[[1, 1], [1, 2], [2, 2], [2, 1], [1, 1]]]}')
-        geometry.AssignSpatialReference(prepare_state.EPSG4326)
-        feature.SetGeometry(geometry)
+        feature.SetGeometry(ogr.CreateGeometryFromJson('{"type": "Polygon", '
+            '"coordinates": [[[1, 1], [1, 2], [2, 2], [2, 1], [1, 1]]]}'))
         
-        feature_e = prepare_state.excerpt_feature(feature, bbox_geom)
+        geojson = json.loads(prepare_state.excerpt_feature_json(feature, field_names, bbox_geom))
+        geometry_e = ogr.CreateGeometryFromJson(json.dumps(geojson['geometry']))
         
-        self.assertEqual(feature_e.GetField('Population'), feature.GetField('Population'))
-        self.assertEqual(feature_e.GetField(prepare_state.FRACTION_FIELD), 0)
-        self.assertEqual(feature_e.GetGeometryRef().GetArea(), 0)
+        self.assertEqual(geojson['properties']['Population'], 999)
+        self.assertEqual(geojson['properties'][prepare_state.FRACTION_FIELD], 0)
+        self.assertEqual(geometry_e.GetArea(), 0)
         
-    def test_excerpt_feature_point_inside(self):
-        ''' excerpt_feature() works with an interior point.
+    def test_excerpt_feature_json_point_inside(self):
+        ''' excerpt_feature_json() works with an interior point.
         '''
-        bbox_geom = ogr.CreateGeometryFromJson('{"type": "Polygon", '
-            '"coordinates": [[[0, 0], [0, 2], [2, 2], [2, 0], [0, 0]]]}')
-        bbox_geom.AssignSpatialReference(prepare_state.EPSG4326)
+        bbox_geom = prepare_state.bbox_geometry(0, 0, 2, 2)
         
-        field_defn = ogr.FieldDefn('Population', ogr.OFTInteger)
         feature_defn = ogr.FeatureDefn()
-        feature_defn.AddFieldDefn(field_defn)
+        feature_defn.AddFieldDefn(ogr.FieldDefn('Population', ogr.OFTInteger))
         feature_defn.AddFieldDefn(ogr.FieldDefn(prepare_state.FRACTION_FIELD, ogr.OFTReal))
+        field_names = ['Population', prepare_state.FRACTION_FIELD]
         
         feature = ogr.Feature(feature_defn)
         feature.SetField('Population', 999)
-        geometry = ogr.CreateGeometryFromJson('{"type": "Point", '
-            '"coordinates": [1, 1]}')
-        geometry.AssignSpatialReference(prepare_state.EPSG4326)
-        feature.SetGeometry(geometry)
+        feature.SetGeometry(ogr.CreateGeometryFromJson('{"type": "Point", '
+            '"coordinates": [1, 1]}'))
         
-        feature_e = prepare_state.excerpt_feature(feature, bbox_geom)
+        geojson = json.loads(prepare_state.excerpt_feature_json(feature, field_names, bbox_geom))
         
-        self.assertEqual(feature_e.GetField('Population'), feature.GetField('Population'))
-        self.assertIsNone(feature_e.GetField(prepare_state.FRACTION_FIELD))
-        self.assertEqual(feature_e.GetGeometryRef().GetGeometryType(), ogr.wkbPoint)
+        self.assertEqual(geojson['properties']['Population'], 999)
+        self.assertIsNone(geojson['properties'][prepare_state.FRACTION_FIELD])
+        self.assertEqual(geojson['geometry'], {'type': 'Point', 'coordinates': [1, 1]})
         
-    def test_excerpt_feature_point_outside(self):
-        ''' excerpt_feature() works with an outside point.
+    def test_excerpt_feature_json_point_outside(self):
+        ''' excerpt_feature_json() works with an outside point.
         '''
-        bbox_geom = ogr.CreateGeometryFromJson('{"type": "Polygon", '
-            '"coordinates": [[[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]]]}')
-        bbox_geom.AssignSpatialReference(prepare_state.EPSG4326)
+        bbox_geom = prepare_state.bbox_geometry(0, 0, 1, 1)
         
-        field_defn = ogr.FieldDefn('Population', ogr.OFTInteger)
         feature_defn = ogr.FeatureDefn()
-        feature_defn.AddFieldDefn(field_defn)
+        feature_defn.AddFieldDefn(ogr.FieldDefn('Population', ogr.OFTInteger))
         feature_defn.AddFieldDefn(ogr.FieldDefn(prepare_state.FRACTION_FIELD, ogr.OFTReal))
+        field_names = ['Population', prepare_state.FRACTION_FIELD]
         
         feature = ogr.Feature(feature_defn)
         feature.SetField('Population', 999)
-        geometry = ogr.CreateGeometryFromJson('{"type": "Point", '
-            '"coordinates": [2, 2]}')
-        geometry.AssignSpatialReference(prepare_state.EPSG4326)
-        feature.SetGeometry(geometry)
+        feature.SetGeometry(ogr.CreateGeometryFromJson('{"type": "Point", '
+            '"coordinates": [2, 2]}'))
+        
+        geojson = json.loads(prepare_state.excerpt_feature_json(feature, field_names, bbox_geom))
+        geometry_e = ogr.CreateGeometryFromJson(json.dumps(geojson['geometry']))
+        
+        self.assertEqual(geojson['properties']['Population'], 999)
+        self.assertIsNone(geojson['properties'][prepare_state.FRACTION_FIELD])
+        self.assertTrue(geometry_e.IsEmpty())
+    
+    def test_process_tile(self):
+        ''' process_tile() returns a gzipped tile of excerpted features.
+        '''
+        filename = os.path.join(os.path.dirname(__file__), 'data', 'null-plan.geojson')
+        tile_bbox = next(prepare_state.iter_extent_tiles((-.001, .001, -.001, .001), 12))
+        
+        prepare_state._worker.clear()
+        key, body = prepare_state.process_tile(*tile_bbox, filename, 'XX/000', True, [0, 1])
+        geojson = json.loads(gzip.decompress(body).decode('utf8'))
+        
+        self.assertEqual(key, 'data/XX/000/12/2047/2047.geojson')
+        self.assertEqual(len(geojson['features']), 2)
+        
+        for feature in geojson['features']:
+            self.assertIn(prepare_state.FRACTION_FIELD, feature['properties'])
+            self.assertGreater(feature['properties'][prepare_state.AREA_FIELD], 0)
+    
+    def test_process_tile_fids(self):
+        ''' process_tile() excerpts only the indexed features it is given.
+        '''
+        filename = os.path.join(os.path.dirname(__file__), 'data', 'null-plan.geojson')
+        tile_bbox = next(prepare_state.iter_extent_tiles((-.001, .001, -.001, .001), 12))
+        
+        prepare_state._worker.clear()
+        key, body = prepare_state.process_tile(*tile_bbox, filename, 'XX/000', True, [0])
+        geojson = json.loads(gzip.decompress(body).decode('utf8'))
+        
+        self.assertEqual(key, 'data/XX/000/12/2047/2047.geojson')
+        self.assertEqual([f['properties']['NAME'] for f in geojson['features']], ['District A'])
+    
+    def test_process_tile_cached_feature(self):
+        ''' process_tile() reads each indexed feature only once across tiles.
+        '''
+        filename = os.path.join(os.path.dirname(__file__), 'data', 'null-plan.geojson')
+        tiles = prepare_state.iter_extent_tiles((-.001, .001, -.001, .001), 12)
+        
+        prepare_state._worker.clear()
+        prepare_state.process_tile(*next(tiles), filename, 'XX/000', True, [0, 1])
+        prepare_state.process_tile(*next(tiles), filename, 'XX/000', True, [0, 1])
+        
+        cache_info = prepare_state.cached_feature.cache_info()
+        self.assertEqual((cache_info.hits, cache_info.misses), (2, 2))
+        self.assertIs(prepare_state.cached_feature(filename, 0),
+            prepare_state.cached_feature(filename, 0))
+    
+    def test_process_tile_local(self):
+        ''' process_tile() writes a tile of excerpted features to a local file.
+        '''
+        filename = os.path.join(os.path.dirname(__file__), 'data', 'null-plan.geojson')
+        tile_bbox = next(prepare_state.iter_extent_tiles((-.001, .001, -.001, .001), 12))
+        dirname, cwd = tempfile.mkdtemp(prefix='test_process_tile_local-'), os.getcwd()
+        
+        try:
+            os.chdir(dirname)
+            prepare_state._worker.clear()
+            key, body = prepare_state.process_tile(*tile_bbox, filename, 'XX/000', False, [0, 1])
+            
+            with open(key) as file:
+                geojson = json.load(file)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(dirname)
+        
+        self.assertEqual(key, 'data/XX/000/12/2047/2047.geojson')
+        self.assertIsNone(body)
+        self.assertEqual(len(geojson['features']), 2)
+    
+    def test_upload_tile(self):
+        ''' upload_tile() uploads a gzipped tile body.
+        '''
+        s3 = unittest.mock.Mock()
+        message = prepare_state.upload_tile(s3, 'data/XX/000/12/2047/2047.geojson', b'x' * 2048)
         
-        feature_e = prepare_state.excerpt_feature(feature, bbox_geom)
+        (body, bucket, key), kwargs = s3.upload_fileobj.mock_calls[0][1:]
         
-        self.assertEqual(feature_e.GetField('Population'), feature.GetField('Population'))
-        self.assertIsNone(feature_e.GetField(prepare_state.FRACTION_FIELD))
-        self.assertTrue(feature_e.GetGeometryRef().IsEmpty())
+        self.assertEqual(message, 'data/XX/000/12/2047/2047.geojson - 2.0KB')
+        self.assertEqual(body.getvalue(), b'x' * 2048)
+        self.assertEqual(key, 'data/XX/000/12/2047/2047.geojson')
+        self.assertEqual(kwargs['ExtraArgs']['ContentEncoding'], 'gzip')
+        self.assertIs(kwargs['Config'], prepare_state.TRANSFER_CONFIG)
@@ -23,6 +23,13 @@ def mock_s3_get_object(Bucket, Key):
 
 class TestScore (unittest.TestCase):
 
+    def test_scored_field_names(self):
+        ''' Only known score fields are returned from scored_field_names(), in order.
+        '''
+        self.assertEqual(score.scored_field_names(('GEOID', 'DEM999', 'Voters',
+            'PlanScore:Fraction', 'Red Votes', 'REP000')), ('Voters', 'Red Votes', 'REP000', 'DEM999'))
+        self.assertEqual(score.scored_field_names(('GEOID', 'NAME')), ())
+    
     def test_swing_vote(self):
         ''' Vote swing is correctly calculated
         '''
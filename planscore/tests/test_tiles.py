@@ -19,6 +19,9 @@ def mock_s3_get_object(Bucket, Key):
 
 class TestTiles (unittest.TestCase):
 
+    def setUp(self):
+        tiles._tile_precincts.clear()
+
     def test_get_tile_zxy(self):
         '''
         '''
@@ -39,6 +42,10 @@ class TestTiles (unittest.TestCase):
         self.assertAlmostEqual(e2, -122.255859375, 9)
         self.assertAlmostEqual(s2, 37.788081384120, 9)
         self.assertAlmostEqual(n2, 37.857507156252, 9)
+        
+        tile_geom1, tile_geom2 = tiles.tile_geometry('12/656/1582'), tiles.tile_geometry('12/656/1582')
+        self.assertIsNot(tile_geom1, tile_geom2)
+        self.assertTrue(tile_geom1.Equals(tile_geom2))
     
     def test_load_upload_geometries(self):
         ''' Expected geometries are retrieved from S3.
@@ -48,10 +55,11 @@ class TestTiles (unittest.TestCase):
         upload.id = 'sample-plan'
 
         s3.get_object.side_effect = mock_s3_get_object
-        s3.list_objects.return_value = {'Contents': [
-            {'Key': "uploads/sample-plan/geometries/0.wkt"},
-            {'Key': "uploads/sample-plan/geometries/1.wkt"}
-            ]}
+        s3.get_paginator.return_value.paginate.return_value = [
+            {'Contents': [{'Key': "uploads/sample-plan/geometries/0.wkt"}]},
+            {'Contents': [{'Key': "uploads/sample-plan/geometries/1.wkt"}]},
+            {},
+            ]
 
         geometries = tiles.load_upload_geometries(storage, upload)
 
@@ -59,8 +67,25 @@ class TestTiles (unittest.TestCase):
         self.assertIn("uploads/sample-plan/geometries/0.wkt", geometries)
         self.assertIn("uploads/sample-plan/geometries/1.wkt", geometries)
         
-        s3.list_objects.assert_called_once_with(Bucket='bucket-name',
-            Prefix="uploads/sample-plan/geometries/")
+        s3.get_paginator.assert_called_once_with('list_objects_v2')
+        s3.get_paginator.return_value.paginate.assert_called_once_with(
+            Bucket='bucket-name', Prefix="uploads/sample-plan/geometries/")
+
+    def test_load_upload_geometry(self):
+        ''' Geometries stored as WKB or WKT are both loaded.
+        '''
+        s3 = unittest.mock.Mock()
+        storage = data.Storage(s3, 'bucket-name', 'XX')
+        geometry = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,1 1,1 -1,-1 -1))')
+        
+        s3.get_object.return_value = {'Body': io.BytesIO(bytes(geometry.ExportToWkb()))}
+        geometry1 = tiles.load_upload_geometry(storage, 'uploads/sample-plan/geometries/0.wkb')
+        self.assertTrue(geometry1.Equals(geometry))
+        
+        s3.get_object.return_value = {'Body': io.BytesIO(gzip.compress(geometry.ExportToWkt().encode('utf8'))),
+            'ContentEncoding': 'gzip'}
+        geometry2 = tiles.load_upload_geometry(storage, 'uploads/sample-plan/geometries/0.wkt')
+        self.assertTrue(geometry2.Equals(geometry))
 
     def test_load_tile_precincts(self):
         ''' Expected tiles are loaded from S3.
@@ -75,6 +100,27 @@ class TestTiles (unittest.TestCase):
 
         precincts2 = tiles.load_tile_precincts(storage, '12/-1/-1')
         self.assertEqual(len(precincts2), 0)
+
+    def test_load_tile_precincts_cached(self):
+        ''' Repeat tiles are loaded from memory instead of S3.
+        '''
+        s3 = unittest.mock.Mock()
+        s3.get_object.side_effect = mock_s3_get_object
+        storage1 = data.Storage(s3, 'bucket-name', 'XX')
+        storage2 = data.Storage(s3, 'bucket-name', 'YY')
+
+        precincts1 = tiles.load_tile_precincts(storage1, '12/2047/2047')
+        precincts2 = tiles.load_tile_precincts(storage1, '12/2047/2047')
+        self.assertIs(precincts1, precincts2)
+        self.assertEqual(len(s3.get_object.mock_calls), 1)
+        
+        tiles.load_tile_precincts(storage2, '12/2047/2047')
+        self.assertEqual(len(s3.get_object.mock_calls), 2)
+        
+        with unittest.mock.patch('planscore.tiles.TILE_PRECINCTS_CACHE_SIZE', 1):
+            tiles.load_tile_precincts(storage1, '12/2047/2048')
+            tiles.load_tile_precincts(storage1, '12/2047/2047')
+            self.assertEqual(len(s3.get_object.mock_calls), 4)
     
     @unittest.mock.patch('planscore.tiles.score_precinct')
     def test_score_district(self, score_precinct):
@@ -92,8 +138,91 @@ class TestTiles (unittest.TestCase):
         
         self.assertEqual(len(score_precinct.mock_calls), 2)
         self.assertEqual(score_precinct.mock_calls[0][1], (intersection, precincts[0], tile_geom))
+        
+        precinct_geoms = [unittest.mock.Mock(), unittest.mock.Mock()]
+        tiles.score_district(district_geom, precincts, tile_geom, precinct_geoms=precinct_geoms)
+        self.assertIs(score_precinct.mock_calls[3][2]['precinct_geom'], precinct_geoms[1])
+        
+        self.assertEqual(len(tile_geom.Within.mock_calls), 2, 'Should check once per district')
+        self.assertIs(score_precinct.mock_calls[3][2]['tile_within_district'], tile_geom.Within.return_value)
         self.assertEqual(score_precinct.mock_calls[1][1], (intersection, precincts[1], tile_geom))
     
+    @unittest.mock.patch('planscore.tiles.score_precinct')
+    def test_score_district_envelopes(self, score_precinct):
+        ''' Precincts outside the district envelope are counted without scoring.
+        '''
+        score_precinct.return_value = {'Voters': 1.111111111}
+        
+        district_geom = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,0.11 1,0.11 -1,-1 -1))')
+        tile_geom = tiles.tile_geometry('12/2049/2046')
+        precincts = [{"properties": {"Voters": 1}}, {"properties": {"Voters": 1}},
+            {"properties": {"Voters": 1}}]
+        precinct_envelopes = [(.09, .1, .09, .1), (.12, .16, .12, .16), None]
+
+        totals = tiles.score_district(district_geom, precincts, tile_geom, precinct_envelopes)
+        self.assertEqual(totals['Voters'], round(1.111111111, constants.ROUND_COUNT))
+        
+        self.assertEqual(len(score_precinct.mock_calls), 1)
+        self.assertIs(score_precinct.mock_calls[0][1][1], precincts[0])
+    
+    def test_score_district_points(self):
+        ''' Block-points located together score the same as one at a time.
+        '''
+        district_geom = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,0.11 1,0.11 -1,-1 -1))')
+        tile_geom = tiles.tile_geometry('12/2049/2046')
+        precincts = [
+            {"properties": {"Voters": 1}, "geometry": {"type": "Point", "coordinates": [.1, .1]}},
+            {"properties": {"Voters": 2}, "geometry": {"type": "Point", "coordinates": [.12, .12]}},
+            {"properties": {"Voters": 4}, "geometry": {"type": "Point", "coordinates": [.11, .1]}},
+            {"properties": {"Voters": 8, "PlanScore:Fraction": 1}, "geometry": {"type": "Polygon",
+                "coordinates": [[[.09, .09], [.09, .1], [.1, .1], [.1, .09], [.09, .09]]]}},
+            ]
+        precinct_points = [tiles.geojson_point(feat['geometry']) for feat in precincts]
+        self.assertEqual(precinct_points, [(.1, .1), (.12, .12), (.11, .1), None])
+        
+        totals1 = tiles.score_district(district_geom, precincts, tile_geom)
+        totals2 = tiles.score_district(district_geom, precincts, tile_geom,
+            precinct_points=precinct_points)
+        self.assertEqual(totals1['Voters'], 9)
+        self.assertEqual(totals2['Voters'], 9)
+        
+        # Only non-point precincts need parsed geometries
+        precinct_geoms = [None, None, None, tiles.precinct_geometry(precincts[3])]
+        big_district_geom = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,1 1,1 -1,-1 -1))')
+        
+        with unittest.mock.patch('osgeo.ogr.CreateGeometryFromJson') as CreateGeometryFromJson:
+            totals3 = tiles.score_district(district_geom, precincts, tile_geom,
+                precinct_geoms=precinct_geoms, precinct_points=precinct_points)
+            totals4 = tiles.score_district(big_district_geom, precincts, tile_geom,
+                precinct_geoms=precinct_geoms, precinct_points=precinct_points)
+
+        self.assertEqual(totals3['Voters'], 9)
+        self.assertEqual(totals4['Voters'], 15)
+        self.assertEqual(len(CreateGeometryFromJson.mock_calls), 0)
+    
+    def test_points_within(self):
+        ''' Only points strictly inside a polygon are returned from points_within().
+        '''
+        square = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((0 0,0 2,2 2,2 0,0 0))')
+        points = [(1, 1), (1.5, 0.5), (2, 1), (3, 3)]
+        self.assertEqual(tiles.points_within(points, square), {(1, 1), (1.5, 0.5)})
+        self.assertEqual(tiles.points_within(points[:1], square), {(1, 1)})
+        self.assertEqual(tiles.points_within(points[3:], square), set())
+        
+        line = osgeo.ogr.CreateGeometryFromWkt('LINESTRING (0 0,2 2)')
+        self.assertIsNone(tiles.points_within(points, line))
+    
+    def test_geojson_envelope(self):
+        ''' Correct envelopes are returned from geojson_envelope().
+        '''
+        self.assertEqual(tiles.geojson_envelope({"type": "Point", "coordinates": [1, 2]}), (1, 1, 2, 2))
+        self.assertEqual(tiles.geojson_envelope({"type": "MultiPolygon", "coordinates":
+            [[[[0, 0], [0, 1], [1, 1], [0, 0]]], [[[2, 2], [2, 3], [3, 3], [2, 2]]]]}), (0, 3, 0, 3))
+        self.assertEqual(tiles.geojson_envelope({"type": "GeometryCollection", "geometries": [
+            {"type": "Point", "coordinates": [1, 2]}, {"type": "Point", "coordinates": [3, 4]}]}), (1, 3, 2, 4))
+        self.assertIsNone(tiles.geojson_envelope({"type": "GeometryCollection", "geometries": []}))
+        self.assertIsNone(tiles.geojson_envelope(None))
+    
     @unittest.mock.patch('planscore.tiles.score_precinct')
     def test_score_district_disjoint(self, score_precinct):
         ''' No precincts are scored for a disjoint tile/district.
@@ -163,6 +292,37 @@ class TestTiles (unittest.TestCase):
         totals = tiles.score_precinct(district_geom.Intersection(tile_geom), precinct, tile_geom)
         self.assertAlmostEqual(totals['Voters'], .5, 9)
     
+    def test_score_precinct_2a_parsed_geometry(self):
+        ''' An already-parsed precinct geometry is used instead of the GeoJSON.
+        '''
+        district_geom = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,0.17 1,0.17 -1,-1 -1))')
+        tile_geom = tiles.tile_geometry('12/2049/2046')
+
+        precinct = {"type": "Feature", "properties": {"Voters": 1, "PlanScore:Fraction": 0.5}, "geometry": {"type": "Polygon", "coordinates": [[[.12, .12], [.12, .16], [.16, .16], [.16, .12], [.12, .12]]]}}
+        precinct_geom = tiles.precinct_geometry(precinct)
+        
+        with unittest.mock.patch('osgeo.ogr.CreateGeometryFromJson') as CreateGeometryFromJson:
+            totals = tiles.score_precinct(district_geom.Intersection(tile_geom),
+                precinct, tile_geom, precinct_geom=precinct_geom)
+        
+        self.assertAlmostEqual(totals['Voters'], .5, 9)
+        self.assertEqual(len(CreateGeometryFromJson.mock_calls), 0)
+    
+    def test_score_precinct_2a_no_intersection(self):
+        ''' No intersection is built for a precinct within district from tile overlapping district.
+        '''
+        district_geom = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,0.17 1,0.17 -1,-1 -1))')
+        tile_geom = tiles.tile_geometry('12/2049/2046')
+        partial_district_geom = district_geom.Intersection(tile_geom)
+
+        precinct = {"type": "Feature", "properties": {"Voters": 1, "PlanScore:Fraction": 0.5}, "geometry": {"type": "Polygon", "coordinates": [[[.12, .12], [.12, .16], [.16, .16], [.16, .12], [.12, .12]]]}}
+        
+        with unittest.mock.patch('osgeo.ogr.Geometry.Intersection') as Intersection:
+            totals = tiles.score_precinct(partial_district_geom, precinct, tile_geom)
+        
+        self.assertFalse(Intersection.called)
+        self.assertAlmostEqual(totals['Voters'], .5, 9)
+    
     def test_score_precinct_2b_tile_overlaps_precinct_overlaps(self):
         ''' Correct voter count for a precinct overlapping district from tile overlapping district.
         '''
@@ -174,6 +334,26 @@ class TestTiles (unittest.TestCase):
         totals = tiles.score_precinct(district_geom.Intersection(tile_geom), precinct, tile_geom)
         self.assertAlmostEqual(totals['Voters'], .25, 9)
     
+    def test_score_precinct_2a_recorded_area(self):
+        ''' A precinct within the district counts fully, whatever its recorded area.
+        '''
+        district_geom = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,0.17 1,0.17 -1,-1 -1))')
+        tile_geom = tiles.tile_geometry('12/2049/2046')
+
+        precinct = {"type": "Feature", "properties": {"Voters": 1, "PlanScore:Fraction": 0.5, "PlanScore:Area": 0.0015}, "geometry": {"type": "Polygon", "coordinates": [[[.12, .12], [.12, .16], [.16, .16], [.16, .12], [.12, .12]]]}}
+        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), precinct, tile_geom)
+        self.assertAlmostEqual(totals['Voters'], .5, 9)
+    
+    def test_score_precinct_2b_recorded_area(self):
+        ''' A precinct area recorded in the tile is used instead of calculated.
+        '''
+        district_geom = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,0.14 1,0.14 -1,-1 -1))')
+        tile_geom = tiles.tile_geometry('12/2049/2046')
+
+        precinct = {"type": "Feature", "properties": {"Voters": 1, "PlanScore:Fraction": 0.5, "PlanScore:Area": 0.004}, "geometry": {"type": "Polygon", "coordinates": [[[.12, .12], [.12, .16], [.16, .16], [.16, .12], [.12, .12]]]}}
+        totals = tiles.score_precinct(district_geom.Intersection(tile_geom), precinct, tile_geom)
+        self.assertAlmostEqual(totals['Voters'], .1, 9)
+    
     def test_score_precinct_2c_tile_overlaps_precinct_touches(self):
         ''' Correct voter count for a precinct touching district from tile overlapping district.
         '''
@@ -196,6 +376,36 @@ class TestTiles (unittest.TestCase):
         totals = tiles.score_precinct(district_geom.Intersection(tile_geom), precinct, tile_geom)
         self.assertAlmostEqual(totals['Voters'], 0., 9)
     
+    def test_score_precinct_2d_envelopes_disjoint(self):
+        ''' No intersection is attempted for a precinct away from the district envelope.
+        '''
+        district_geom = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,0.11 1,0.11 -1,-1 -1))')
+        tile_geom = tiles.tile_geometry('12/2049/2046')
+        partial_district_geom = district_geom.Intersection(tile_geom)
+
+        precinct = {"type": "Feature", "properties": {"Voters": 1, "PlanScore:Fraction": 0.5}, "geometry": {"type": "Polygon", "coordinates": [[[.12, .12], [.12, .16], [.16, .16], [.16, .12], [.12, .12]]]}}
+        
+        with unittest.mock.patch('osgeo.ogr.Geometry.Intersection') as Intersection:
+            totals = tiles.score_precinct(partial_district_geom, precinct, tile_geom)
+
+        self.assertAlmostEqual(totals['Voters'], 0., 9)
+        self.assertEqual(len(Intersection.mock_calls), 0)
+    
+    def test_score_precinct_2d_no_intersects(self):
+        ''' No intersection is attempted for a precinct that misses the district.
+        '''
+        district_geom = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1.26,1.26 -1,-1 -1))')
+        tile_geom = tiles.tile_geometry('12/2049/2046')
+        partial_district_geom = district_geom.Intersection(tile_geom)
+
+        precinct = {"type": "Feature", "properties": {"Voters": 1, "PlanScore:Fraction": 0.5}, "geometry": {"type": "Polygon", "coordinates": [[[.16, .16], [.16, .17], [.17, .17], [.17, .16], [.16, .16]]]}}
+        
+        with unittest.mock.patch('osgeo.ogr.Geometry.Intersection') as Intersection:
+            totals = tiles.score_precinct(partial_district_geom, precinct, tile_geom)
+
+        self.assertAlmostEqual(totals['Voters'], 0., 9)
+        self.assertEqual(len(Intersection.mock_calls), 0)
+    
     def test_score_precinct_2e_tile_overlaps_blockpoint_within(self):
         ''' Correct voter count for a block-point within district from tile overlapping district.
         '''
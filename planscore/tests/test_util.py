@@ -1,4 +1,5 @@
-import unittest, unittest.mock, io, os, logging, tempfile, shutil
+import unittest, unittest.mock, io, os, logging, tempfile, shutil, gzip
+from osgeo import ogr
 from .. import util, constants
 
 class TestUtil (unittest.TestCase):
@@ -19,6 +20,50 @@ class TestUtil (unittest.TestCase):
         self.assertEqual(data, buffer.getvalue())
         self.assertFalse(os.path.exists(path))
     
+    def test_cached_object(self):
+        ''' Objects written to the local cache can be read back.
+        '''
+        with unittest.mock.patch('planscore.constants.TILE_CACHE_DIR', self.tempdir):
+            self.assertIsNone(util.read_cached_object('bucket', 'data/XX/1.geojson'))
+            util.write_cached_object('bucket', 'data/XX/1.geojson', b'Hello world')
+            self.assertEqual(util.read_cached_object('bucket', 'data/XX/1.geojson'), b'Hello world')
+            self.assertEqual(os.listdir(os.path.join(self.tempdir, 'bucket', 'data/XX')), ['1.geojson'])
+    
+    def test_cached_object_disabled(self):
+        ''' Nothing is cached without a cache directory.
+        '''
+        with unittest.mock.patch('planscore.constants.TILE_CACHE_DIR', None):
+            util.write_cached_object('bucket', 'data/XX/1.geojson', b'Hello world')
+            self.assertIsNone(util.read_cached_object('bucket', 'data/XX/1.geojson'))
+    
+    def test_cached_object_write_error(self):
+        ''' A failed cache write leaves no partial file behind.
+        '''
+        with unittest.mock.patch('planscore.constants.TILE_CACHE_DIR', self.tempdir), \
+             unittest.mock.patch('os.replace') as replace:
+            replace.side_effect = OSError('No space left on device')
+            util.write_cached_object('bucket', 'data/XX/1.geojson', b'Hello world')
+            self.assertIsNone(util.read_cached_object('bucket', 'data/XX/1.geojson'))
+            self.assertEqual(os.listdir(os.path.join(self.tempdir, 'bucket', 'data/XX')), [])
+    
+    def test_read_object_body(self):
+        ''' read_object_body() decompresses gzipped S3 objects.
+        '''
+        plain = {'Body': io.BytesIO(b'Hello world')}
+        gzipped = {'Body': io.BytesIO(gzip.compress(b'Hello world')), 'ContentEncoding': 'gzip'}
+        
+        self.assertEqual(util.read_object_body(plain), b'Hello world')
+        self.assertEqual(util.read_object_body(gzipped), b'Hello world')
+    
+    def test_load_geometry(self):
+        ''' load_geometry() accepts either WKB or WKT bytes.
+        '''
+        geometry = ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,1 1,1 -1,-1 -1))')
+        
+        for body in (geometry.ExportToWkt().encode('utf8'), bytes(geometry.ExportToWkb(ogr.wkbNDR)),
+            bytes(geometry.ExportToWkb(ogr.wkbXDR))):
+            self.assertTrue(util.load_geometry(body).Equals(geometry))
+    
     @unittest.mock.patch('sys.stdout')
     def test_unzip_shapefile(self, stdout):
         ''' Shapefile is found within a zip file.
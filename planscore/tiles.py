@@ -1,49 +1,71 @@
-import json, io, gzip, posixpath, functools, collections
-import osgeo.ogr, boto3, botocore.exceptions, ModestMaps.OpenStreetMap, ModestMaps.Core
+import json, posixpath, functools, collections, concurrent.futures
+import osgeo.ogr, boto3, botocore.exceptions
 from . import constants, data, util, prepare_state, score
 
 FUNCTION_NAME = 'PlanScore-RunTile'
 
-# Borrow some Modest Maps tile math
-_mercator = ModestMaps.OpenStreetMap.Provider().projection
+# Number of district geometries to request from S3 at once
+GEOMETRY_FETCHERS = 8
+
+# Parsed tile features by (bucket, prefix, tile), least-recently used first
+TILE_PRECINCTS_CACHE_SIZE = 64
+_tile_precincts = collections.OrderedDict()
 
 def load_upload_geometries(storage, upload):
     ''' Get OGR geometries for an upload.
-    '''
-    geometries = {}
     
+        Geometries are requested from S3 in parallel threads, so a plan with
+        many districts waits for the slowest one rather than the sum of all.
+    '''
     geoms_prefix = posixpath.dirname(data.UPLOAD_GEOMETRIES_KEY).format(id=upload.id)
-    response = storage.s3.list_objects(Bucket=storage.bucket, Prefix=f'{geoms_prefix}/')
-
-    geometry_keys = [object['Key'] for object in response['Contents']]
-    
-    for geometry_key in geometry_keys:
-        object = storage.s3.get_object(Bucket=storage.bucket, Key=geometry_key)
+    paginator = storage.s3.get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=storage.bucket, Prefix=f'{geoms_prefix}/')
 
-        if object.get('ContentEncoding') == 'gzip':
-            object['Body'] = io.BytesIO(gzip.decompress(object['Body'].read()))
+    # Plans with more than a thousand districts span several listing pages
+    geometry_keys = [object['Key'] for page in pages for object in page.get('Contents', [])]
     
-        district_geom = osgeo.ogr.CreateGeometryFromWkt(object['Body'].read().decode('utf8'))
-        geometries[geometry_key] = district_geom
+    with concurrent.futures.ThreadPoolExecutor(GEOMETRY_FETCHERS) as executor:
+        district_geoms = executor.map(functools.partial(load_upload_geometry, storage), geometry_keys)
+        geometries = dict(zip(geometry_keys, district_geoms))
     
     return geometries
 
+def load_upload_geometry(storage, geometry_key):
+    ''' Get one OGR geometry for an upload, stored as WKB or older WKT.
+    '''
+    object = storage.s3.get_object(Bucket=storage.bucket, Key=geometry_key)
+    return util.load_geometry(util.read_object_body(object))
+
 def load_tile_precincts(storage, tile_zxy):
     ''' Get GeoJSON features for a specific tile.
+    
+        Recently-parsed features are kept in memory by bucket, prefix, and tile
+        so a warm container can skip S3 and JSON parsing for repeat tiles.
+        Returned lists are shared, so callers must not modify them.
     '''
+    cache_key = (storage.bucket, storage.prefix, tile_zxy)
+    
+    if cache_key in _tile_precincts:
+        _tile_precincts.move_to_end(cache_key)
+        return _tile_precincts[cache_key]
+    
     try:
         object = storage.s3.get_object(Bucket=storage.bucket,
             Key='{}/{}.geojson'.format(storage.prefix, tile_zxy))
     except botocore.exceptions.ClientError as error:
         if error.response['Error']['Code'] == 'NoSuchKey':
-            return []
-        raise
-
-    if object.get('ContentEncoding') == 'gzip':
-        object['Body'] = io.BytesIO(gzip.decompress(object['Body'].read()))
+            features = []
+        else:
+            raise
+    else:
+        features = json.loads(util.read_object_body(object))['features']
     
-    geojson = json.load(object['Body'])
-    return geojson['features']
+    _tile_precincts[cache_key] = features
+    
+    while len(_tile_precincts) > TILE_PRECINCTS_CACHE_SIZE:
+        _tile_precincts.popitem(last=False)
+    
+    return features
 
 def get_tile_zxy(model_key_prefix, tile_key):
     '''
@@ -51,21 +73,100 @@ def get_tile_zxy(model_key_prefix, tile_key):
     tile_zxy, _ = posixpath.splitext(posixpath.relpath(tile_key, model_key_prefix))
     return tile_zxy
 
-@functools.lru_cache(maxsize=16)
+@functools.lru_cache(maxsize=512)
+def _tile_wkb(tile_zxy):
+    ''' Get WKB bytes for a web mercator tile.
+    '''
+    (z, x, y) = map(int, tile_zxy.split('/'))
+    W, E = prepare_state.tile_longitude(x, z), prepare_state.tile_longitude(x + 1, z)
+    N, S = prepare_state.tile_latitude(y, z), prepare_state.tile_latitude(y + 1, z)
+    
+    return bytes(prepare_state.bbox_geometry(W, S, E, N).ExportToWkb())
+
 def tile_geometry(tile_zxy):
     ''' Get an OGR Geometry for a web mercator tile.
+    
+        Each call returns a new geometry built from cached WKB, so callers
+        never share one OGR object.
     '''
-    (z, x, y) = map(int, tile_zxy.split('/'))
-    coord = ModestMaps.Core.Coordinate(y, x, z)
-    NW = _mercator.coordinateLocation(coord)
-    SE = _mercator.coordinateLocation(coord.right().down())
-    wkt = 'POLYGON(({W} {N},{W} {S},{E} {S},{E} {N},{W} {N}))'.format(
-        N=NW.lat, W=NW.lon, S=SE.lat, E=SE.lon)
+    return osgeo.ogr.CreateGeometryFromWkb(_tile_wkb(tile_zxy))
+
+def iter_positions(coordinates):
+    ''' Generate (x, y, ...) positions from nested GeoJSON coordinates.
+    '''
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        yield coordinates
+    else:
+        for child in coordinates:
+            yield from iter_positions(child)
 
-    return osgeo.ogr.CreateGeometryFromWkt(wkt)
+def geojson_envelope(geometry):
+    ''' Return an (xmin, xmax, ymin, ymax) envelope for a GeoJSON geometry.
+    
+        Returns None for a missing or empty geometry.
+    '''
+    if geometry is None:
+        return None
+    elif geometry['type'] == 'GeometryCollection':
+        envelopes = [geojson_envelope(child) for child in geometry['geometries']]
+        envelopes = [envelope for envelope in envelopes if envelope is not None]
+        if not envelopes:
+            return None
+        xmins, xmaxes, ymins, ymaxes = zip(*envelopes)
+        return min(xmins), max(xmaxes), min(ymins), max(ymaxes)
+    
+    positions = list(iter_positions(geometry['coordinates']))
+    
+    if not positions:
+        return None
+    
+    xs, ys = [position[0] for position in positions], [position[1] for position in positions]
+    return min(xs), max(xs), min(ys), max(ys)
 
-def score_district(district_geom, precincts, tile_geom):
+def precinct_geometry(precinct_feat):
+    ''' Get an OGR Geometry for a precinct feature.
+    '''
+    return osgeo.ogr.CreateGeometryFromJson(json.dumps(precinct_feat['geometry']))
+
+def geojson_point(geometry):
+    ''' Return (x, y) for a single GeoJSON point, or None for anything else.
+    '''
+    if geometry is None or geometry['type'] != 'Point' or not geometry['coordinates']:
+        return None
+    
+    return tuple(geometry['coordinates'][:2])
+
+def points_within(points, geometry):
+    ''' Return the set of (x, y) points strictly within a polygonal geometry.
+    
+        One GEOS overlay locates every point at once, instead of a separate
+        Within() call per point. Returns None for non-polygonal geometries.
+    '''
+    if osgeo.ogr.GT_Flatten(geometry.GetGeometryType()) not in (osgeo.ogr.wkbPolygon,
+        osgeo.ogr.wkbMultiPolygon):
+        return None
+    
+    multipoint = osgeo.ogr.Geometry(osgeo.ogr.wkbMultiPoint)
+
+    for (x, y) in points:
+        point = osgeo.ogr.Geometry(osgeo.ogr.wkbPoint)
+        point.AddPoint_2D(x, y)
+        multipoint.AddGeometry(point)
+    
+    # Within() excludes points on the boundary, so remove those here as well
+    inside = multipoint.Intersection(geometry).Difference(geometry.Boundary())
+    parts = [inside.GetGeometryRef(i) for i in range(inside.GetGeometryCount())] or [inside]
+    
+    return {part.GetPoint_2D(0) for part in parts if not part.IsEmpty()}
+
+def score_district(district_geom, precincts, tile_geom, precinct_envelopes=None,
+    precinct_geoms=None, precinct_points=None):
     ''' Return weighted precinct totals for a district over a tile.
+    
+        Envelopes, OGR geometries, and block-point locations of each precinct,
+        computed once per tile and shared by all districts, can be passed to
+        skip precincts nowhere near the district, avoid parsing the same
+        GeoJSON repeatedly, and locate all block-points together.
     '''
     totals = collections.defaultdict(int)
     
@@ -73,22 +174,61 @@ def score_district(district_geom, precincts, tile_geom):
         return totals
     
     partial_district_geom = district_geom.Intersection(tile_geom)
+    
+    if precinct_envelopes is not None:
+        partial_district_xxyy = partial_district_geom.GetEnvelope()
+    
+    # Check this once for all precincts in the tile instead of once for each
+    tile_within_district = tile_geom.Within(partial_district_geom)
+    
+    if precinct_points is not None and any(precinct_points) and not tile_within_district:
+        inside_points = points_within([point for point in precinct_points
+            if point is not None], partial_district_geom)
+    else:
+        inside_points = None
 
-    for precinct_feat in precincts:
-        subtotals = score_precinct(partial_district_geom, precinct_feat, tile_geom)
+    for (index, precinct_feat) in enumerate(precincts):
+        if precinct_envelopes is not None and (precinct_envelopes[index] is None
+            or prepare_state.envelopes_disjoint(precinct_envelopes[index], partial_district_xxyy)):
+            # Precinct can't overlap the district, so it counts for nothing
+            property_names = tuple(precinct_feat['properties'])
+            subtotals = dict.fromkeys(score.scored_field_names(property_names), 0)
+        elif precinct_points is not None and precinct_points[index] is not None \
+            and (tile_within_district or inside_points is not None):
+            # Block-point has no area, so it counts fully or not at all
+            properties = precinct_feat['properties']
+            point_fraction = 1 if (tile_within_district
+                or precinct_points[index] in inside_points) else 0
+            subtotals = {name: point_fraction * (properties[name] or 0)
+                for name in score.scored_field_names(tuple(properties))}
+        else:
+            subtotals = score_precinct(partial_district_geom, precinct_feat, tile_geom,
+                precinct_geom=(precinct_geoms[index] if precinct_geoms else None),
+                tile_within_district=tile_within_district)
+        
         for (name, value) in subtotals.items():
-            totals[name] = round(value + totals[name], constants.ROUND_COUNT)
+            totals[name] += value
+    
+    # Round once at the end instead of after every precinct
+    for name in totals:
+        totals[name] = round(totals[name], constants.ROUND_COUNT)
 
     return totals
 
-def score_precinct(partial_district_geom, precinct_feat, tile_geom):
+def score_precinct(partial_district_geom, precinct_feat, tile_geom, precinct_geom=None,
+    tile_within_district=None):
     ''' Return weighted single-district totals for a precinct feature within a tile.
         
         partial_district_geom is the intersection of district and tile geometries.
+        precinct_geom is an optional already-parsed geometry of precinct_feat,
+        and tile_within_district an optional already-known tile_geom.Within().
     '''
-    # Initialize totals to zero
-    totals = {name: 0 for name in score.FIELD_NAMES if name in precinct_feat['properties']}
-    precinct_geom = osgeo.ogr.CreateGeometryFromJson(json.dumps(precinct_feat['geometry']))
+    # Initialize totals to zero, looking up fields once per property schema
+    properties = precinct_feat['properties']
+    totals = dict.fromkeys(score.scored_field_names(tuple(properties)), 0)
+    
+    if precinct_geom is None:
+        precinct_geom = precinct_geometry(precinct_feat)
     
     if precinct_geom is None or precinct_geom.IsEmpty():
         # If there's no precinct geometry here, don't bother.
@@ -103,13 +243,16 @@ def score_precinct(partial_district_geom, precinct_feat, tile_geom):
         precinct_frac = 1
     else:
         precinct_is_point = False
-        precinct_frac = precinct_feat['properties'][prepare_state.FRACTION_FIELD]
+        precinct_frac = properties[prepare_state.FRACTION_FIELD]
 
     if precinct_frac == 0:
         # If there's no overlap here, don't bother.
         return totals
 
-    if tile_geom.Within(partial_district_geom):
+    if tile_within_district is None:
+        tile_within_district = tile_geom.Within(partial_district_geom)
+
+    if tile_within_district:
         # Don't laboriously calculate precinct fraction if we know it's all there.
         # This is safe because precincts are clipped on tile boundaries, so a
         # fully-contained tile necessarily means the precinct is also contained.
@@ -117,26 +260,48 @@ def score_precinct(partial_district_geom, precinct_feat, tile_geom):
     elif precinct_is_point:
         # Do simple inside/outside check for points
         precinct_fraction = precinct_frac if precinct_geom.Within(partial_district_geom) else 0
+    elif prepare_state.envelopes_disjoint(precinct_geom.GetEnvelope(),
+        partial_district_geom.GetEnvelope()):
+        # If it's nowhere near the district, don't bother.
+        return totals
     else:
+        # Tiles record clipped precinct areas, except for those built earlier
+        precinct_area = properties.get(prepare_state.AREA_FIELD)
+        
         try:
-            overlap_geom = precinct_geom.Intersection(partial_district_geom)
+            if not precinct_geom.Intersects(partial_district_geom):
+                # Cheaper predicate settles precincts that miss the district.
+                return totals
+            elif precinct_geom.Within(partial_district_geom):
+                # Predicates are cheaper than overlays, so skip building an
+                # intersection for a precinct that's entirely in the district.
+                overlap_geom = None
+            else:
+                overlap_geom = precinct_geom.Intersection(partial_district_geom)
         except RuntimeError as e:
             if 'TopologyException' in str(e) and not precinct_geom.IsValid():
                 # Sometimes, a precinct geometry can be invalid
                 # so inflate it by a tiny amount to smooth out problems
                 precinct_geom = precinct_geom.Buffer(0.0000001)
+                precinct_area = None
                 overlap_geom = precinct_geom.Intersection(partial_district_geom)
             else:
                 raise
-        if precinct_geom.Area() == 0:
-            # If we're about to divide by zero, don't bother.
-            return totals
-
-        overlap_area = overlap_geom.Area() / precinct_geom.Area()
-        precinct_fraction = overlap_area * precinct_frac
+        if overlap_geom is None:
+            # All of it is in the district, so there's no area to compare.
+            precinct_fraction = precinct_frac
+        else:
+            if precinct_area is None:
+                precinct_area = precinct_geom.Area()
+            if precinct_area == 0:
+                # If we're about to divide by zero, don't bother.
+                return totals
+    
+            overlap_area = overlap_geom.Area() / precinct_area
+            precinct_fraction = overlap_area * precinct_frac
     
     for name in totals:
-        precinct_value = precinct_fraction * (precinct_feat['properties'][name] or 0)
+        precinct_value = precinct_fraction * (properties[name] or 0)
         totals[name] = round(precinct_value, constants.ROUND_COUNT)
     
     return totals
@@ -155,10 +320,17 @@ def lambda_handler(event, context):
 
         totals = {}
         precincts = load_tile_precincts(storage, tile_zxy)
+        precinct_envelopes = [geojson_envelope(feat['geometry']) for feat in precincts]
+        precinct_points = [geojson_point(feat['geometry']) for feat in precincts]
+        
+        # Block-points are located from their coordinates, so only parse the rest
+        precinct_geoms = [precinct_geometry(feat) if point is None else None
+            for (feat, point) in zip(precincts, precinct_points)]
         geometries = load_upload_geometries(storage, upload)
     
         for (geometry_key, district_geom) in geometries.items():
-            totals[geometry_key] = score_district(district_geom, precincts, tile_geom)
+            totals[geometry_key] = score_district(district_geom, precincts,
+                tile_geom, precinct_envelopes, precinct_geoms, precinct_points)
     except Exception as err:
         totals = str(err)
 
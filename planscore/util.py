@@ -1,5 +1,6 @@
-import urllib.parse, tempfile, shutil, os, contextlib, logging, zipfile, itertools, shutil
+import urllib.parse, tempfile, shutil, os, contextlib, logging, zipfile, itertools, shutil, zlib
 import boto3
+from osgeo import ogr
 from . import constants
 
 class SQSLoggingHandler(logging.Handler):
@@ -25,6 +26,75 @@ def temporary_buffer_file(filename, buffer):
     finally:
         shutil.rmtree(dirname)
 
+def cached_object_path(bucket, key):
+    ''' Return a local path for a cached S3 object, or None if not caching.
+    '''
+    if constants.TILE_CACHE_DIR is None:
+        return None
+    
+    return os.path.join(constants.TILE_CACHE_DIR, bucket, key)
+
+def read_cached_object(bucket, key):
+    ''' Return bytes of an S3 object previously cached locally, or None.
+    '''
+    path = cached_object_path(bucket, key)
+    
+    if path is None or not os.path.exists(path):
+        return None
+    
+    with open(path, 'rb') as file:
+        return file.read()
+
+def write_cached_object(bucket, key, body):
+    ''' Cache bytes of an S3 object locally, if there is room.
+    
+        Caching is best-effort, so a failed write is quietly skipped.
+    '''
+    path = cached_object_path(bucket, key)
+    
+    if path is None:
+        return
+    
+    dirname, temp_path = os.path.dirname(path), None
+    
+    try:
+        os.makedirs(dirname, exist_ok=True)
+        
+        if shutil.disk_usage(dirname).free - len(body) < constants.TILE_CACHE_MIN_FREE:
+            return
+        
+        # Write to a temporary name first so readers never see a partial file
+        handle, temp_path = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(handle, 'wb') as file:
+            file.write(body)
+        os.replace(temp_path, path)
+    except OSError:
+        # A full or unwritable disk should only cost us the cache
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def read_object_body(object):
+    ''' Return bytes of an S3 get_object() response, decompressed if gzipped.
+    '''
+    body = object['Body'].read()
+    
+    if object.get('ContentEncoding') == 'gzip':
+        # Objects are single-member gzip, so zlib can inflate them in one step
+        # without gzip.decompress() reading through a GzipFile in Python.
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    
+    return body
+
+def load_geometry(body):
+    ''' Return an OGR geometry from WKB or WKT bytes.
+    
+        WKB starts with a byte-order flag of 0 or 1, which can't begin WKT.
+    '''
+    if body[:1] in (b'\x00', b'\x01'):
+        return ogr.CreateGeometryFromWkb(body)
+    
+    return ogr.CreateGeometryFromWkt(body.decode('utf8'))
+
 def unzip_shapefile(zip_path, zip_dir):
     ''' Unzip shapefile found within zip file into named directory.
     '''